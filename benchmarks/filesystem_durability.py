@@ -0,0 +1,62 @@
+'''
+Writes/sec for each FileSystemDict durability mode.
+
+    python benchmarks/filesystem_durability.py --threads 16 --writes 200 --value-size 4096
+
+Run it against the file system you actually care about with --path. tmpfs ignores fsync and
+will make every mode look the same.
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from shitty_tools.key_value.filesystem import FileSystemDict, _syncfs
+
+
+def run(durability, path, threads, writes, value_size, fanout_levels, group_commit_syncfs = False):
+    base_path = tempfile.mkdtemp(dir=path)
+    try:
+        storage_path = os.path.join(base_path, 'storage')
+        scratch_path = os.path.join(base_path, 'scratch')
+        os.mkdir(storage_path)
+        os.mkdir(scratch_path)
+        fs_dict = FileSystemDict(storage_path, scratch_path, fanout_levels=fanout_levels, durability=durability,
+                                 group_commit_syncfs=group_commit_syncfs)
+        value = os.urandom(value_size)
+
+        def writer(thread_number):
+            for i in xrange(writes):
+                fs_dict['%s-%s' % (thread_number, i)] = value
+
+        thread_list = [threading.Thread(target=writer, args=(n,)) for n in xrange(threads)]
+        start = time.time()
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+        return threads * writes / (time.time() - start)
+    finally:
+        shutil.rmtree(base_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=None, help='directory to benchmark in (default: system temp dir)')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=200, help='writes per thread')
+    parser.add_argument('--value-size', type=int, default=4096)
+    parser.add_argument('--fanout-levels', type=int, default=0)
+    args = parser.parse_args()
+    modes = [('none', 'none', False), ('fsync', 'fsync', False), ('group', 'group', False)]
+    if _syncfs is not None:
+        modes.append(('group+syncfs', 'group', True))
+    for name, durability, group_commit_syncfs in modes:
+        writes_per_second = run(durability, args.path, args.threads, args.writes, args.value_size,
+                                args.fanout_levels, group_commit_syncfs)
+        print('%-12s %10.1f writes/sec' % (name, writes_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+'''
+Runs standard workloads against the key_value backends and wrappers and reports ops/sec and
+p50/p99/p999 latency as JSON, so runs can be compared over time.
+
+Everything runs locally: file backends in a temp dir, SQLite files, a redis-server started on a free
+port (skipped if there isn't one on the PATH) and a flask_kv app served in-process over loopback.
+
+    python benchmarks/kv_suite.py --output results.json
+    python benchmarks/kv_suite.py --backends sqlite,flask_kv --threads 1,16 --baseline results.json
+
+Workloads:
+    read_heavy   95% reads, 5% writes
+    mixed        50% reads, 50% writes
+    write_heavy  5% reads, 95% writes
+    scan         full iterations of the keys, reported per pass and as keys_per_sec
+
+Each backend is loaded with --keys keys per value size, then every workload runs at every thread
+count, --ops operations in total split between the threads. With --baseline, any result whose
+ops/sec dropped by more than --tolerance from the matching baseline result is listed on stderr
+and the exit status is 1.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import pickle
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from distutils.spawn import find_executable
+from shitty_tools.concurrent import construct_daemon_thread
+from shitty_tools.key_value.filesystem import FileSystemDict
+from shitty_tools.key_value.packfile import PackFileDict
+from shitty_tools.key_value.sql.generic_sql import GenericSqlDict
+from shitty_tools.key_value.sql.sqlite import SqliteDict
+from shitty_tools.key_value.utility import TieredStorageDict, ShardedDict, SerializedDict, InstrumentedDict
+
+
+WORKLOADS = {'read_heavy': 0.95, 'mixed': 0.5, 'write_heavy': 0.05, 'scan': None}
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _filesystem_dict(base_path):
+    storage_path = os.path.join(base_path, 'storage')
+    scratch_path = os.path.join(base_path, 'scratch')
+    os.mkdir(storage_path)
+    os.mkdir(scratch_path)
+    return FileSystemDict(storage_path, scratch_path)
+
+
+def _sqlite_url(base_path, name):
+    return 'sqlite:///%s' % os.path.join(base_path, name)
+
+
+def construct_dict(base_path):
+    return {}, None
+
+
+def construct_filesystem(base_path):
+    return _filesystem_dict(base_path), None
+
+
+def construct_packfile(base_path):
+    kv_dict = PackFileDict(base_path)
+    return kv_dict, kv_dict.close
+
+
+def construct_generic_sql(base_path):
+    kv_dict = GenericSqlDict(_sqlite_url(base_path, 'generic.db'), 'kv')
+    return kv_dict, kv_dict.close
+
+
+def construct_sqlite(base_path):
+    kv_dict = SqliteDict(_sqlite_url(base_path, 'sqlite.db'), 'kv')
+    return kv_dict, kv_dict.close
+
+
+def construct_redis(base_path):
+    from redis import Redis
+    from shitty_tools.key_value.redis import RedisDict
+    port = _free_port()
+    process = subprocess.Popen([find_executable('redis-server'), '--port', str(port), '--bind', '127.0.0.1',
+                                '--save', '', '--appendonly', 'no', '--dir', base_path],
+                               stdout=open(os.devnull, 'w'))
+    redis_conn = Redis('127.0.0.1', port)
+    for _ in xrange(100):
+        try:
+            redis_conn.ping()
+            break
+        except Exception:
+            time.sleep(0.05)
+    else:
+        process.kill()
+        raise Exception('redis-server did not start on port %s' % port)
+    def close():
+        process.kill()
+        process.wait()
+    return RedisDict(redis_conn, key_prefix='bench:'), close
+
+
+def construct_flask_kv(base_path):
+    from werkzeug.serving import make_server
+    from shitty_tools.key_value.flask_kv.server import construct_kv_app
+    from shitty_tools.key_value.flask_kv.client import FlaskKvDict
+    # werkzeug's development server, so this is a floor on per-request overhead rather than what a
+    # production WSGI server would manage. Its per-request logging would swamp the progress output.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', _free_port(), construct_kv_app({}), threaded=True)
+    construct_daemon_thread(server.serve_forever).start()
+    kv_dict = FlaskKvDict('http://127.0.0.1:%s/' % server.server_port, max_connections=16)
+    def close():
+        kv_dict.close()
+        server.shutdown()
+        server.server_close()
+    return kv_dict, close
+
+
+def construct_tiered(base_path):
+    # An in-memory cache in front of files
+    return TieredStorageDict([{}, _filesystem_dict(base_path)]), None
+
+
+def construct_sharded(base_path):
+    shards = []
+    for i in xrange(4):
+        shard_path = os.path.join(base_path, 'shard%s' % i)
+        os.mkdir(shard_path)
+        shards.append(_filesystem_dict(shard_path))
+    return ShardedDict(shards), None
+
+
+def construct_serialized(base_path):
+    # Pickling over a plain dict, so this is the cost of the wrapper itself
+    return SerializedDict({}, value_serialize=lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                          value_deserialize=pickle.loads), None
+
+
+def construct_instrumented(base_path):
+    # Recording over a plain dict, with a snapshot callback running as it would in production
+    kv_dict = InstrumentedDict({}, snapshot_callback=lambda snapshot: None, snapshot_interval=1)
+    return kv_dict, kv_dict.close
+
+
+BACKENDS = [('dict', construct_dict),
+            ('filesystem', construct_filesystem),
+            ('packfile', construct_packfile),
+            ('generic_sql', construct_generic_sql),
+            ('sqlite', construct_sqlite),
+            ('redis', construct_redis),
+            ('flask_kv', construct_flask_kv),
+            ('tiered', construct_tiered),
+            ('sharded', construct_sharded),
+            ('serialized', construct_serialized),
+            ('instrumented', construct_instrumented)]
+
+
+def available(backend_name):
+    if backend_name == 'redis':
+        return find_executable('redis-server') is not None
+    return True
+
+
+def percentile(sorted_latencies, fraction):
+    if not sorted_latencies:
+        return None
+    return sorted_latencies[min(len(sorted_latencies) - 1, int(len(sorted_latencies) * fraction))]
+
+
+def run_workload(kv_dict, keys, value, read_fraction, threads, ops, scans):
+    '''
+    :return: (latencies in seconds, errors, elapsed seconds)
+    '''
+    latency_lists = [[] for _ in xrange(threads)]
+    error_counts = [0] * threads
+
+    def worker(thread_number):
+        latencies = latency_lists[thread_number]
+        rng = random.Random(thread_number)
+        if read_fraction is None:
+            operations = xrange(scans)
+        else:
+            operations = xrange(ops // threads + (thread_number < ops % threads))
+        for _ in operations:
+            start = time.time()
+            try:
+                if read_fraction is None:
+                    for _ in kv_dict:
+                        pass
+                elif rng.random() < read_fraction:
+                    kv_dict[rng.choice(keys)]
+                else:
+                    kv_dict[rng.choice(keys)] = value
+            except Exception:
+                error_counts[thread_number] += 1
+                continue
+            latencies.append(time.time() - start)
+
+    thread_list = [threading.Thread(target=worker, args=(n,)) for n in xrange(threads)]
+    start = time.time()
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    elapsed = time.time() - start
+    latencies = sorted(latency for latency_list in latency_lists for latency in latency_list)
+    return latencies, sum(error_counts), elapsed
+
+
+def run_backend(backend_name, constructor, args):
+    results = []
+    for value_size in args.value_sizes:
+        base_path = tempfile.mkdtemp(dir=args.path)
+        close = None
+        try:
+            kv_dict, close = constructor(base_path)
+            keys = ['key%08d' % i for i in xrange(args.keys)]
+            value = os.urandom(value_size)
+            for key in keys:
+                kv_dict[key] = value
+            for threads in args.threads:
+                for workload in args.workloads:
+                    latencies, errors, elapsed = run_workload(kv_dict, keys, value, WORKLOADS[workload],
+                                                              threads, args.ops, args.scans)
+                    result = {'backend': backend_name,
+                              'workload': workload,
+                              'value_size': value_size,
+                              'threads': threads,
+                              'ops': len(latencies),
+                              'errors': errors,
+                              'seconds': elapsed,
+                              'ops_per_sec': len(latencies) / elapsed if elapsed else None,
+                              'p50_us': None, 'p99_us': None, 'p999_us': None}
+                    for name, fraction in (('p50_us', 0.5), ('p99_us', 0.99), ('p999_us', 0.999)):
+                        if latencies:
+                            result[name] = percentile(latencies, fraction) * 1e6
+                    if workload == 'scan':
+                        result['keys_per_sec'] = len(latencies) * len(keys) / elapsed if elapsed else None
+                    results.append(result)
+                    sys.stderr.write('%-12s %-12s %8s bytes %4s threads %12.1f ops/sec %10.1f p99 us\n' %
+                                     (backend_name, workload, value_size, threads, result['ops_per_sec'] or 0,
+                                      result['p99_us'] or 0))
+        finally:
+            if close is not None:
+                close()
+            shutil.rmtree(base_path)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    result_key = lambda result: (result['backend'], result['workload'], result['value_size'], result['threads'])
+    baseline_results = dict((result_key(result), result) for result in baseline['results'])
+    for result in results:
+        before = baseline_results.get(result_key(result))
+        if before is None or not before['ops_per_sec'] or result['ops_per_sec'] is None:
+            continue
+        if result['ops_per_sec'] < before['ops_per_sec'] * (1 - tolerance):
+            yield result, before
+
+
+def int_list(text):
+    return [int(part) for part in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default=','.join(name for name, _ in BACKENDS),
+                        help='comma separated, from: %s' % ', '.join(name for name, _ in BACKENDS))
+    parser.add_argument('--workloads', default='read_heavy,mixed,write_heavy,scan')
+    parser.add_argument('--value-sizes', type=int_list, default=[128, 16384])
+    parser.add_argument('--threads', type=int_list, default=[1, 8])
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--ops', type=int, default=2000, help='operations per run, split between the threads')
+    parser.add_argument('--scans', type=int, default=3, help='full iterations per thread for the scan workload')
+    parser.add_argument('--path', default=None, help='directory to benchmark in (default: system temp dir)')
+    parser.add_argument('--output', default=None, help='file to write the JSON to (default: stdout)')
+    parser.add_argument('--baseline', default=None, help='JSON from an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fractional drop in ops/sec that counts '
+                                                                     'as a regression')
+    args = parser.parse_args()
+    args.backends = args.backends.split(',')
+    args.workloads = args.workloads.split(',')
+    constructors = dict(BACKENDS)
+    for name in args.backends:
+        if name not in constructors:
+            parser.error('Unknown backend: %s' % name)
+    for workload in args.workloads:
+        if workload not in WORKLOADS:
+            parser.error('Unknown workload: %s' % workload)
+
+    results = []
+    for name in args.backends:
+        if not available(name):
+            sys.stderr.write('%-12s skipped, redis-server is not on the PATH\n' % name)
+            continue
+        results.extend(run_backend(name, constructors[name], args))
+
+    report = {'config': {'keys': args.keys, 'ops': args.ops, 'scans': args.scans,
+                         'value_sizes': args.value_sizes, 'threads': args.threads},
+              'results': results}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressed = list(regressions(results, baseline, args.tolerance))
+        for result, before in regressed:
+            sys.stderr.write('REGRESSION %-12s %-12s %8s bytes %4s threads %12.1f -> %.1f ops/sec\n' %
+                             (result['backend'], result['workload'], result['value_size'], result['threads'],
+                              before['ops_per_sec'], result['ops_per_sec']))
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+Per-operation latency of GenericSqlDict on an in-memory SQLite database, compared with the old way
+of running each operation-- a new scoped_session and a freshly built statement for every call.
+
+    python benchmarks/sql_fast_path.py --ops 20000 --value-size 256
+'''
+import os
+import time
+import argparse
+from sqlalchemy import insert, select, desc
+from sqlalchemy.orm import sessionmaker, scoped_session
+from shitty_tools.key_value.sql.generic_sql import GenericSqlDict
+
+
+class SessionPerOpSqlDict(GenericSqlDict):
+    '''
+    GenericSqlDict reads and writes as they were before they ran cached statements on pooled connections
+    '''
+    def __init__(self, *args, **kwargs):
+        super(SessionPerOpSqlDict, self).__init__(*args, **kwargs)
+        session_maker = sessionmaker(self._engine.engine)
+        self._get_session = lambda: scoped_session(session_maker)
+
+
+    def _read(self, key):
+        select_statement = select([self._kv_table.c.item, self._kv_table.c.is_deleted]).\
+            where(self._kv_table.c.label == key).order_by(desc(self._kv_table.c.sequence_number)).limit(1)
+        with self._get_session().no_autoflush as session:
+            result = session.execute(select_statement).fetchone()
+            if result is None or result.is_deleted:
+                raise KeyError
+        session.close()
+        return result.item
+
+
+    def _write(self, key, value, is_deleted):
+        insert_statement = insert(self._kv_table, values = {'label': key, 'item': value, 'is_deleted': is_deleted})
+        with self._get_session().no_autoflush as session:
+            session.execute(insert_statement)
+            session.commit()
+        session.close()
+
+
+def percentile(sorted_latencies, fraction):
+    return sorted_latencies[min(len(sorted_latencies) - 1, int(len(sorted_latencies) * fraction))]
+
+
+def measure(operation, keys):
+    latencies = []
+    for key in keys:
+        start = time.time()
+        operation(key)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return sum(latencies) / len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+def run(kv_dict, keys, value):
+    def set_one(key):
+        kv_dict[key] = value
+    def get_one(key):
+        kv_dict[key]
+    return [('set', measure(set_one, keys)), ('get', measure(get_one, keys))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ops', type=int, default=10000)
+    parser.add_argument('--value-size', type=int, default=256)
+    args = parser.parse_args()
+    keys = ['key%08d' % i for i in xrange(args.ops)]
+    value = os.urandom(args.value_size)
+    print('%-20s %-6s %10s %10s %10s' % ('', '', 'mean us', 'p50 us', 'p99 us'))
+    for name, dict_class in (('session per op', SessionPerOpSqlDict), ('core fast path', GenericSqlDict)):
+        kv_dict = dict_class('sqlite://', 'kv')
+        for operation, (mean, p50, p99) in run(kv_dict, keys, value):
+            print('%-20s %-6s %10.1f %10.1f %10.1f' % (name, operation, mean * 1e6, p50 * 1e6, p99 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
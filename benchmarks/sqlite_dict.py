@@ -0,0 +1,74 @@
+'''
+Compares SqliteDict with and without history against GenericSqlDict on the same SQLite file and
+against FileSystemDict.
+
+    python benchmarks/sqlite_dict.py --keys 5000 --value-size 256
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from shitty_tools.key_value.filesystem import FileSystemDict
+from shitty_tools.key_value.sql.generic_sql import GenericSqlDict
+from shitty_tools.key_value.sql.sqlite import SqliteDict
+
+
+def construct_backends(base_path):
+    storage_path = os.path.join(base_path, 'fs_storage')
+    scratch_path = os.path.join(base_path, 'fs_scratch')
+    os.mkdir(storage_path)
+    os.mkdir(scratch_path)
+    sqlite_url = lambda name: 'sqlite:///%s' % os.path.join(base_path, name)
+    return [('FileSystemDict', FileSystemDict(storage_path, scratch_path)),
+            ('GenericSqlDict', GenericSqlDict(sqlite_url('generic.db'), 'kv')),
+            ('SqliteDict history', SqliteDict(sqlite_url('history.db'), 'kv', keep_history=True)),
+            ('SqliteDict', SqliteDict(sqlite_url('sqlite.db'), 'kv'))]
+
+
+def timed(f):
+    start = time.time()
+    f()
+    return time.time() - start
+
+
+def run(kv_dict, keys, value):
+    results = []
+    def set_each():
+        for key in keys:
+            kv_dict[key] = value
+    def get_each():
+        for key in keys:
+            kv_dict[key]
+    results.append(('set', timed(set_each)))
+    results.append(('get', timed(get_each)))
+    if hasattr(kv_dict, 'set_many'):
+        results.append(('set_many', timed(lambda: kv_dict.set_many((key, value) for key in keys))))
+        results.append(('get_many', timed(lambda: kv_dict.get_many(keys))))
+    results.append(('iterate', timed(lambda: list(kv_dict))))
+    results.append(('len', timed(lambda: len(kv_dict))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=None, help='directory to benchmark in (default: system temp dir)')
+    parser.add_argument('--keys', type=int, default=2000)
+    parser.add_argument('--value-size', type=int, default=256)
+    args = parser.parse_args()
+    keys = ['key%08d' % i for i in xrange(args.keys)]
+    value = os.urandom(args.value_size)
+    base_path = tempfile.mkdtemp(dir=args.path)
+    try:
+        for name, kv_dict in construct_backends(base_path):
+            for operation, elapsed in run(kv_dict, keys, value):
+                if operation == 'len':
+                    print('%-20s %-10s %10.3f ms' % (name, operation, elapsed * 1000))
+                else:
+                    print('%-20s %-10s %10.1f ops/sec' % (name, operation, len(keys) / elapsed))
+    finally:
+        shutil.rmtree(base_path)
+
+
+if __name__ == '__main__':
+    main()
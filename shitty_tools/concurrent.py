@@ -1,7 +1,11 @@
+import logging
 import threading
 from Queue import Queue
 
 
+_log = logging.getLogger(__name__)
+
+
 def construct_daemon_thread(f):
     '''
     Convenience function that takes a function 'f' and returns:
@@ -21,6 +25,37 @@ def construct_daemon_thread(f):
     return f_thread
 
 
+def construct_periodic_thread(f, interval, description = None, stop_event = None):
+    '''
+    Returns a daemon thread that waits `interval` seconds and calls `f`, until `stop_event` is set.
+    Exceptions from `f` are logged and the loop carries on, so one failure doesn't stop it for good.
+    Like construct_daemon_thread, the thread still needs to be started.
+
+    >>> stop_event = threading.Event()
+    >>> flush_thread = construct_periodic_thread(flush, 10, 'flush', stop_event)
+    >>> flush_thread.start()
+    >>> stop_event.set()
+    >>> flush_thread.join()
+
+    :param f: function that takes no arguments
+    :param interval: seconds between calls
+    :param description: what f does, for the log message if it fails
+    :param stop_event: threading.Event that ends the loop when set, without waiting out the interval.
+     If it isn't given, the thread runs until the process exits.
+    :return: a thread that calls f periodically
+    '''
+    if stop_event is None:
+        stop_event = threading.Event()
+    def loop():
+        while not stop_event.wait(interval):
+            try:
+                f()
+            except Exception:
+                # Try again next time around rather than killing the thread
+                _log.exception('%s failed', description or f)
+    return construct_daemon_thread(loop)
+
+
 def queue_wrap_function(input_queue, output_queue, f):
     '''
     Given input and output queues and a function, constructs a thread that
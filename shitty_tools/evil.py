@@ -1,8 +1,13 @@
 from sqlalchemy.orm import relationship
-from sqlalchemy import and_
+from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy import and_, select, bindparam
+from sqlalchemy.exc import IntegrityError
+from .key_value.utility import chunks
+from .sqla.statements import insert_ignore_statement
 
 
-def create_attribute_associator(entity_id_col, eav_cls, eav_entity_id_col, eav_attr_col, eav_value_col):
+def create_attribute_associator(entity_id_col, eav_cls, eav_entity_id_col, eav_attr_col, eav_value_col,
+                                pivot = False):
     '''
     Returns a class method that allows one to associate attributes in an Entity-Attribute-Value table
     with a sqlalchemy class and then access those attributes as properties of the entity class.
@@ -42,18 +47,52 @@ def create_attribute_associator(entity_id_col, eav_cls, eav_entity_id_col, eav_a
     '_bar_obj', '_bar_set', '_decl_class_registry', '_foo_get', '_foo_obj', '_foo_set', '_sa_class_manager',
     'bar', 'foo', 'id', 'metadata', 'name']
 
+    By default each attribute is its own relationship, joined into every query of the entity. With
+    many attributes that's one outer join each. With pivot=True there's a single relationship to
+    all of an entity's EAV rows, keyed by attribute name, loaded 'selectin' style-- one extra
+    query per batch of entities, WHERE entity id IN (...), however many attributes there are.
+    In that mode attributes an entity doesn't have read as None, and add_attribute's lazy
+    argument is ignored.
+
 
     :param entity_id_col: The id column of your entity
     :param eav_cls: The sqlalchemy class of the entity attribute value (EAV) table
     :param eav_entity_id_col: The foreign key column from the EAV table to the entity table
     :param eav_attr_col: The EAV table column that stores the attribute name
     :param eav_value_col: The EAV table column that stores the attribute value
+    :param pivot: load all of an entity's attributes with one relationship instead of one each
     :return: class method to with signature like add_attribute(cls, attr_name, lazy='joined')
     '''
     attr_col_name = eav_attr_col.key
     value_col_name = eav_value_col.key
+    rows_name = '_%s_rows' % eav_cls.__tablename__
+
+    def add_pivoted_attribute(cls, attr_name):
+        if rows_name not in cls.__dict__:
+            setattr(cls, rows_name, relationship(eav_cls,
+                                                 primaryjoin=entity_id_col == eav_entity_id_col,
+                                                 collection_class=attribute_mapped_collection(attr_col_name),
+                                                 lazy='selectin'))
+        getter_name = '_%s_get' % attr_name
+        setter_name = '_%s_set' % attr_name
+        def getter(self):
+            obj = getattr(self, rows_name).get(attr_name)
+            return None if obj is None else getattr(obj, value_col_name)
+        def setter(self, value):
+            rows = getattr(self, rows_name)
+            obj = rows.get(attr_name)
+            if obj is None:
+                rows[attr_name] = eav_cls(**{attr_col_name: attr_name, value_col_name: value})
+            else:
+                setattr(obj, value_col_name, value)
+        setattr(cls, getter_name, getter)
+        setattr(cls, setter_name, setter)
+        setattr(cls, attr_name, property(getter, setter))
+
     @classmethod
     def add_attribute(cls, attr_name, lazy='joined'):
+        if pivot:
+            return add_pivoted_attribute(cls, attr_name)
         obj_name = '_%s_obj' % attr_name
         getter_name = '_%s_get' % attr_name
         setter_name = '_%s_set' % attr_name
@@ -76,4 +115,85 @@ def create_attribute_associator(entity_id_col, eav_cls, eav_entity_id_col, eav_a
         setattr(cls, getter_name, getter)
         setattr(cls, setter_name, setter)
         setattr(cls, attr_name, prop)
-    return add_attribute
\ No newline at end of file
+    return add_attribute
+
+
+def _column(col):
+    # ORM attributes like Eav.value to their table columns
+    return col.property.columns[0] if hasattr(col, 'property') else col
+
+
+def bulk_set_attributes(db_session, eav_entity_id_col, eav_attr_col, eav_value_col, entity_attributes,
+                        chunk_size = 500):
+    '''
+    Sets attributes on many entities straight through the EAV table, rather than building an ORM
+    object per value. For each chunk_size entities there's one select of the rows that already exist,
+    then one executemany update and one executemany insert.
+
+    Another writer can insert one of the missing rows between the select and the insert. On PostgreSQL,
+    MySQL and SQLite the insert skips rows that already exist (as in get_or_create_list), and if any
+    were skipped the inserted values are written again as updates. Elsewhere each insert runs in a
+    savepoint, and one that hits the unique (entity, attribute) index is retried as an update.
+
+    Entities already loaded in db_session won't see the new values until they're expired or refreshed.
+
+    >>> bulk_set_attributes(db_session, Eav.entity_id, Eav.attribute, Eav.value,
+    ...                     {1: {'foo': 'a', 'bar': 'b'}, 2: {'foo': 'c'}})
+    >>> db_session.commit()
+
+    :param db_session: sqlalchemy session
+    :param eav_entity_id_col: The foreign key column from the EAV table to the entity table
+    :param eav_attr_col: The EAV table column that stores the attribute name
+    :param eav_value_col: The EAV table column that stores the attribute value
+    :param entity_attributes: dict of entity id to a dict of attribute name to value
+    :param chunk_size: entities per round of statements
+    '''
+    entity_id_col, attr_col, value_col = _column(eav_entity_id_col), _column(eav_attr_col), _column(eav_value_col)
+    table = entity_id_col.table
+    update_statement = table.update().\
+        where(and_(entity_id_col == bindparam('_entity_id'), attr_col == bindparam('_attribute'))).\
+        values({value_col.key: bindparam('_value')})
+    dialect_name = db_session.get_bind(clause=table).dialect.name
+    insert_statement = insert_ignore_statement(table, dialect_name)
+    for entity_chunk in chunks(entity_attributes.items(), chunk_size):
+        attr_names = set(attr_name for _, attributes in entity_chunk for attr_name in attributes)
+        if not attr_names:
+            continue
+        existing = set(tuple(row) for row in db_session.execute(
+            select([entity_id_col, attr_col]).
+                where(and_(entity_id_col.in_([entity_id for entity_id, _ in entity_chunk]),
+                           attr_col.in_(attr_names)))))
+        updates, inserts = [], []
+        for entity_id, attributes in entity_chunk:
+            for attr_name, value in attributes.items():
+                update = {'_entity_id': entity_id, '_attribute': attr_name, '_value': value}
+                if (entity_id, attr_name) in existing:
+                    updates.append(update)
+                else:
+                    inserts.append(({entity_id_col.key: entity_id, attr_col.key: attr_name, value_col.key: value},
+                                    update))
+        if updates:
+            db_session.execute(update_statement, updates)
+        if inserts:
+            _insert_or_update(db_session, table, insert_statement, update_statement, inserts)
+
+
+def _insert_or_update(db_session, table, insert_statement, update_statement, inserts):
+    if insert_statement is not None:
+        # rowcount is -1 where the driver can't say, which also means writing them again
+        if db_session.execute(insert_statement, [insert for insert, _ in inserts]).rowcount != len(inserts):
+            db_session.execute(update_statement, [update for _, update in inserts])
+        return
+    try:
+        with db_session.begin_nested():
+            db_session.execute(table.insert(), [insert for insert, _ in inserts])
+        return
+    except IntegrityError:
+        pass
+    # Someone else got at least one of them in first. Find out which, a row at a time.
+    for insert, update in inserts:
+        try:
+            with db_session.begin_nested():
+                db_session.execute(table.insert(), insert)
+        except IntegrityError:
+            db_session.execute(update_statement, update)
@@ -1,16 +1,70 @@
 import os
+import mmap
+import time
+import shutil
+import hashlib
 import tempfile
+import threading
 from collections import MutableMapping
+from contextlib import contextmanager
+try:
+    from urllib import quote, unquote
+except ImportError:
+    # Module was moved in Python3
+    from urllib.parse import quote, unquote
+try:
+    import ctypes
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (ImportError, OSError, AttributeError):
+    # Not Linux
+    _syncfs = None
 
 
 class FileSystemDict(MutableMapping):
-    def __init__(self, storage_path, scratch_path):
+    def __init__(self, storage_path, scratch_path, fanout_levels = 0, fanout_width = 2, durability = 'none',
+                 group_commit_window = 0.002, group_commit_syncfs = False):
         '''
+        By default each key maps directly to a path under storage_path. If fanout_levels is set,
+        keys are instead spread across fanout_levels levels of subdirectories named after the
+        leading characters of the md5 of the key, fanout_width hex characters per level. The
+        file name at the leaf is the quoted key, so `/`'s in keys do not create directories in
+        this mode. Iteration still yields the original keys.
+
+        Use migrate_layout to move an existing store from one layout to another.
+
+        Writes are atomic but by default not durable; after a crash a write may be lost. The
+        durability parameter selects how hard to try--
+        'none': never fsync
+        'fsync': each write fsyncs its data before the rename and its directory after it
+        'group': writes arriving within group_commit_window seconds of each other are fsynced,
+        renamed and have their directories fsynced as a batch. Each write returns once it is
+        durable, and directories shared by the batch are only synced once.
+        In both 'fsync' and 'group' modes a delete syncs the directory the value was removed
+        from before returning, so a deleted key can't come back after a crash.
+
         :param storage_path: directory for storing data
         :param scratch_path: directory for staging writes
+        :param fanout_levels: number of hashed subdirectory levels (0 is the flat layout)
+        :param fanout_width: hex characters of the key hash per subdirectory level
+        :param durability: 'none', 'fsync' or 'group'
+        :param group_commit_window: seconds a group commit waits to collect other writes
+        :param group_commit_syncfs: on Linux, sync a group commit's files and then its directories with
+         one syncfs call each instead of an fsync per file and directory. syncfs flushes everything dirty
+         on the file system, other processes' writes included, so it only pays off when this dict is
+         about the only writer and batches are big.
         '''
         self.storage_path = os.path.abspath(storage_path)
         self.scratch_path = os.path.abspath(scratch_path)
+        self.fanout_levels = fanout_levels
+        self.fanout_width = fanout_width
+        if fanout_levels * fanout_width > 32:
+            raise Exception('Fan-out levels * width may not exceed the 32 characters of an md5 hex digest')
+        if durability not in ('none', 'fsync', 'group'):
+            raise Exception('Durability must be one of none, fsync or group. Received: %s' % durability)
+        self.durability = durability
+        if group_commit_syncfs and _syncfs is None:
+            raise Exception('syncfs is only available on Linux')
+        self._group_committer = _GroupCommitter(self._rename_into_place, group_commit_window, group_commit_syncfs)
 
         if not os.stat(self.storage_path).st_dev == os.stat(self.scratch_path).st_dev:
             # This will pass even if scratch and storage are on different devices in Windows
@@ -36,12 +90,32 @@ class FileSystemDict(MutableMapping):
 
 
     def _get_storage_key_path(self, key):
-        key_path = os.path.abspath(os.path.join(self.storage_path, str(key)))
+        if self.fanout_levels:
+            key_path = os.path.join(self.storage_path, self._get_fanout_relpath(str(key)))
+        else:
+            key_path = os.path.abspath(os.path.join(self.storage_path, str(key)))
         if not key_path.startswith(self.storage_path):
             raise Exception('Attempted file system traversal with key: %s' %key)
         return key_path
 
 
+    def _get_fanout_relpath(self, key):
+        key_hash = hashlib.md5(key).hexdigest()
+        width = self.fanout_width
+        fanout_dirs = [key_hash[i * width:(i + 1) * width] for i in xrange(self.fanout_levels)]
+        filename = quote(key, safe='')
+        if filename.startswith('.'):
+            # Keep '.', '..' and dot files from being special
+            filename = '%2E' + filename[1:]
+        return os.path.join(*(fanout_dirs + [filename]))
+
+
+    def _get_key_from_storage_path(self, path):
+        if self.fanout_levels:
+            return unquote(os.path.basename(path))
+        return os.path.relpath(path, self.storage_path)
+
+
     def __getitem__(self, key):
         try:
             with open(self._get_storage_key_path(key), 'rb') as infile:
@@ -50,43 +124,281 @@ class FileSystemDict(MutableMapping):
             raise KeyError(key)
 
 
+    def open_value(self, key):
+        '''
+        Opens the file backing a value for reading without reading it into memory. The caller
+        is responsible for closing it. Because writes are renames, the open file keeps
+        returning the value as it was when opened even if the key is overwritten or deleted.
+
+        :param key: key to open
+        :return: file object opened in binary read mode
+        '''
+        try:
+            return open(self._get_storage_key_path(key), 'rb')
+        except IOError:
+            raise KeyError(key)
+
+
+    @contextmanager
+    def mmap_value(self, key):
+        '''
+        Context manager that memory maps the file backing a value read only. The mmap can be
+        sliced like a string or read like a file, and pages are only loaded as they are
+        touched. Zero length files can't be mapped, so empty values yield an empty string.
+
+        >>> with fs_dict.mmap_value('big_blob') as value:
+        ...     header = value[:16]
+
+        :param key: key to map
+        '''
+        with self.open_value(key) as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                yield b''
+                return
+            value_map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield value_map
+            finally:
+                value_map.close()
+
+
     def __setitem__(self, key, value):
+        self._write(key, lambda scratch: scratch.write(value))
+
+
+    def set_stream(self, key, source, chunk_size = 1024 * 1024):
+        '''
+        Writes a value from a file-like object or an iterable of strings without holding the
+        whole value in memory. The data is streamed into the scratch path and renamed into
+        place once complete, so readers never see a partial value.
+
+        :param key: key to write
+        :param source: object with a read method, or an iterable of strings
+        :param chunk_size: bytes to read from source at a time if it is file-like
+        '''
+        if hasattr(source, 'read'):
+            write = lambda scratch: shutil.copyfileobj(source, scratch, chunk_size)
+        else:
+            def write(scratch):
+                for chunk in source:
+                    scratch.write(chunk)
+        self._write(key, write)
+
+
+    def _write(self, key, write_function):
         destination_path = self._get_storage_key_path(key)
         scratch = tempfile.NamedTemporaryFile(mode='wb', dir=self.scratch_path, delete=False)
         try:
-            scratch.write(value)
+            write_function(scratch)
+            if self.durability == 'fsync':
+                scratch.flush()
+                os.fsync(scratch.fileno())
         except:
             scratch.close()
             os.remove(scratch.name)
             raise
+        if self.durability == 'group':
+            # Still open, so the committer can fsync it without opening it again. It closes it.
+            scratch.flush()
+            self._group_committer.commit(scratch, destination_path)
+            return
         scratch.close()
+        new_dirs = self._rename_into_place(scratch.name, destination_path)
+        if self.durability == 'fsync':
+            for dir_path in new_dirs:
+                fsync_dir(dir_path)
+
+
+    def _rename_into_place(self, scratch_name, destination_path):
+        '''
+        :return: directories whose entries changed and need syncing for the rename to be durable
+        '''
+        changed_dirs = [os.path.dirname(destination_path)]
+        while not os.path.isdir(changed_dirs[-1]) and changed_dirs[-1] != self.storage_path:
+            # os.renames is about to create this directory, so its parent changes too
+            changed_dirs.append(os.path.dirname(changed_dirs[-1]))
         try:
-            os.renames(scratch.name, destination_path)
+            os.renames(scratch_name, destination_path)
         except OSError as e:
             try:
                 # On Windows you can't overwrite via rename. See if that's the problem.
                 os.remove(destination_path)
-                os.renames(scratch.name, destination_path)
+                os.renames(scratch_name, destination_path)
             except:
                 # If we've got to this point something has gone wrong. Most likely user is trying
                 # to create a subdirectory with the same name as a file.
-                os.remove(scratch.name)
+                os.remove(scratch_name)
                 raise
+        return changed_dirs
 
 
     def __delitem__(self, key):
+        storage_key_path = self._get_storage_key_path(key)
         try:
-            os.remove(self._get_storage_key_path(key))
+            os.remove(storage_key_path)
         except OSError:
             # Non-existant file
             raise KeyError(key)
+        if self.durability != 'none':
+            fsync_dir(os.path.dirname(storage_key_path))
 
 
     def __iter__(self):
         for dirpath, dirnames, filenames in os.walk(self.storage_path):
             for filename in filenames:
-                yield os.path.join(dirpath, filename).lstrip(self.storage_path)
+                yield self._get_key_from_storage_path(os.path.join(dirpath, filename))
 
 
     def __len__(self):
-        return sum([len(filenames) for (dirpath, dirnames, filenames) in os.walk(self.storage_path)])
\ No newline at end of file
+        return sum([len(filenames) for (dirpath, dirnames, filenames) in os.walk(self.storage_path)])
+
+
+class _GroupCommitter(object):
+    def __init__(self, rename_function, window, use_syncfs = False):
+        '''
+        Batches the fsyncs of concurrent writers. The first writer to arrive leads the batch:
+        it waits `window` seconds for others to join, then fsyncs every scratch file, renames
+        them into place, fsyncs each changed directory once and releases the writers. With
+        use_syncfs each of the two sync steps is a single syncfs call instead.
+
+        :param rename_function: function(scratch_name, destination_path) that returns the dirs to sync
+        :param window: seconds the leader waits for other writers
+        :param use_syncfs: sync with syncfs rather than fsync
+        '''
+        self.rename_function = rename_function
+        self.window = window
+        self.use_syncfs = use_syncfs
+        self._lock = threading.Lock()
+        self._pending = []
+
+
+    def commit(self, scratch, destination_path):
+        '''
+        :param scratch: open scratch file, flushed. It's closed before it's renamed.
+        :param destination_path: where to rename it to
+        '''
+        entry = {'scratch': scratch, 'destination_path': destination_path,
+                 'done': threading.Event(), 'error': None}
+        with self._lock:
+            self._pending.append(entry)
+            is_leader = len(self._pending) == 1
+        if is_leader:
+            time.sleep(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            self._commit_batch(batch)
+        entry['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+
+
+    def _commit_batch(self, batch):
+        dirs_to_sync = set()
+        try:
+            self._sync_scratch_files([entry['scratch'] for entry in batch])
+            for entry in batch:
+                try:
+                    dirs_to_sync.update(self.rename_function(entry['scratch'].name, entry['destination_path']))
+                except Exception as e:
+                    entry['error'] = e
+            if dirs_to_sync and self.use_syncfs:
+                _sync_file_system(list(dirs_to_sync)[0])
+            else:
+                for dir_path in dirs_to_sync:
+                    fsync_dir(dir_path)
+        except Exception as e:
+            for entry in batch:
+                entry['error'] = entry['error'] or e
+        finally:
+            for entry in batch:
+                entry['done'].set()
+
+
+    def _sync_scratch_files(self, scratch_files):
+        # Closed here whatever happens, since Windows can't rename open files
+        try:
+            if self.use_syncfs:
+                _sync_file_system(scratch_files[0].name)
+            else:
+                for scratch in scratch_files:
+                    os.fsync(scratch.fileno())
+        finally:
+            for scratch in scratch_files:
+                scratch.close()
+
+
+def _sync_file_system(path):
+    # syncfs flushes everything dirty on the file system path is on, not just this dict's files
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            raise OSError(ctypes.get_errno(), 'syncfs failed')
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path):
+    '''
+    Makes changes to the entries of a directory durable. Does nothing on platforms that can't
+    open directories (Windows).
+
+    :param path: directory to sync
+    '''
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def migrate_layout(source_dict, destination_dict):
+    '''
+    Moves every item in one FileSystemDict into another FileSystemDict with a different layout.
+    Each item is moved with a rename, so nothing is copied and readers of either dict never see
+    a partial value. Directories left empty in the source are removed.
+
+    The destination storage path must be on the same file system as the source and must not be
+    inside it. To convert a store in place, migrate into a sibling directory and swap the
+    directories once this returns.
+
+    >>> old = FileSystemDict('/data/store', '/data/scratch')
+    >>> new = FileSystemDict('/data/store.new', '/data/scratch', fanout_levels = 2)
+    >>> migrate_layout(old, new)
+    >>> os.rename('/data/store', '/data/store.old')
+    >>> os.rename('/data/store.new', '/data/store')
+
+    :param source_dict: FileSystemDict to move items out of
+    :param destination_dict: FileSystemDict to move items into
+    :return: number of items moved
+    '''
+    if not os.stat(source_dict.storage_path).st_dev == os.stat(destination_dict.storage_path).st_dev:
+        raise Exception('Source and destination storage paths must be on the same file system')
+    if (destination_dict.storage_path + os.sep).startswith(source_dict.storage_path + os.sep):
+        raise Exception('Destination storage path must not be inside the source storage path')
+    n = 0
+    # Materialize the keys first so we aren't walking directories while we prune them
+    for key in list(source_dict):
+        source_path = source_dict._get_storage_key_path(key)
+        destination_path = destination_dict._get_storage_key_path(key)
+        destination_dir = os.path.dirname(destination_path)
+        if not os.path.isdir(destination_dir):
+            os.makedirs(destination_dir)
+        os.rename(source_path, destination_path)
+        _prune_empty_dirs(os.path.dirname(source_path), source_dict.storage_path)
+        n += 1
+    return n
+
+
+def _prune_empty_dirs(path, stop_path):
+    # Like os.removedirs, but never removes stop_path or anything above it
+    while path.startswith(stop_path + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        path = os.path.dirname(path)
@@ -1,13 +1,19 @@
 from . import client, server
 
-def FlaskKv(app, kv_store, url_prefix =''):
+def FlaskKv(app, kv_store, url_prefix ='', bulk_chunk_size = 1000, compress_responses = True,
+            min_compress_size = 1024, etags = True):
     '''
     :param app: Your flask application 
     :param kv_store: Something that presents a dictionary interface
     :param url_prefix: The sub-path to use for the key value store. Default is /.
+    :param bulk_chunk_size: keys per call to the store's get_many/set_many from the bulk endpoints
+    :param compress_responses: gzip responses for clients that accept it
+    :param min_compress_size: smallest single value worth gzipping, in bytes
+    :param etags: tag single key reads with an ETag and answer If-None-Match with 304 when it matches
     :return: the generated blueprint for the kv store
     '''
     from . import server
-    blueprint = server.construct_kv_blueprint(kv_store, url_prefix)
+    blueprint = server.construct_kv_blueprint(kv_store, url_prefix, bulk_chunk_size, compress_responses,
+                                              min_compress_size, etags)
     app.register_blueprint(blueprint)
     return blueprint
\ No newline at end of file
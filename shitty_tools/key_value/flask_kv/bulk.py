@@ -0,0 +1,200 @@
+'''
+Body formats for the bulk endpoints and gzip helpers, shared by the server and the client.
+
+NDJSON bodies have one JSON document per line. Keys go one JSON string per line and pairs
+as {"key": ..., "value": ...} objects, so values have to be text.
+
+Framed bodies are binary safe. Each key and each value is a four byte big-endian length
+followed by that many bytes. Keys go one frame each and pairs as a key frame then a value frame.
+'''
+import json
+import zlib
+import struct
+
+NDJSON = 'application/x-ndjson'
+FRAMED = 'application/octet-stream'
+_LENGTH = struct.Struct('>I')
+# zlib wbits for the gzip container
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class IterReader(object):
+    def __init__(self, chunk_iterable, on_close = None):
+        '''
+        File-like reader over an iterable of byte strings, so framed bodies can be parsed from
+        responses and decompressed requests without holding them in memory.
+
+        :param chunk_iterable: iterable of byte strings
+        :param on_close: function to call once when the reader is closed
+        '''
+        self._chunks = iter(chunk_iterable)
+        self._buffer = b''
+        self._on_close = on_close
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += chunk
+                return True
+        return False
+
+    def read(self, size = -1):
+        while size < 0 or len(self._buffer) < size:
+            if not self._fill():
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        while b'\n' not in self._buffer:
+            if not self._fill():
+                break
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+def iter_stream(stream, chunk_size = 64 * 1024):
+    '''
+    :return: generator of chunk_size reads from a file-like object until it's exhausted
+    '''
+    return iter(lambda: stream.read(chunk_size), b'')
+
+
+def gzip_chunks(chunks):
+    '''
+    Gzips an iterable of byte strings as it goes. Each chunk is flushed through, so a streamed
+    response still arrives a chunk at a time.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gunzip_chunks(chunks):
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    yield decompressor.flush()
+
+
+def gzip_bytes(data):
+    return b''.join(gzip_chunks([data]))
+
+
+def body_format(content_type):
+    '''
+    :param content_type: Content-Type header, possibly with parameters
+    :return: NDJSON or FRAMED. Anything that isn't NDJSON is treated as framed.
+    '''
+    if (content_type or '').split(';')[0].strip() == NDJSON:
+        return NDJSON
+    return FRAMED
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+def _read_exactly(stream, length):
+    data = stream.read(length)
+    while len(data) < length:
+        more = stream.read(length - len(data))
+        if not more:
+            raise Exception('Truncated frame. Expected %s bytes, got %s' % (length, len(data)))
+        data += more
+    return data
+
+
+def encode_frame(data):
+    data = _to_bytes(data)
+    return _LENGTH.pack(len(data)) + data
+
+
+def iter_frames(stream):
+    '''
+    :param stream: file-like object with a read method
+    :return: generator of the frames in the stream
+    '''
+    while True:
+        header = stream.read(_LENGTH.size)
+        if not header:
+            return
+        if len(header) < _LENGTH.size:
+            header += _read_exactly(stream, _LENGTH.size - len(header))
+        yield _read_exactly(stream, _LENGTH.unpack(header)[0])
+
+
+def _iter_lines(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def encode_keys(keys, body_type):
+    '''
+    :return: generator of body chunks for a list of keys
+    '''
+    for key in keys:
+        if body_type == NDJSON:
+            yield json.dumps(key) + '\n'
+        else:
+            yield encode_frame(key)
+
+
+def decode_keys(stream, body_type):
+    if body_type == NDJSON:
+        return _iter_lines(stream)
+    return iter_frames(stream)
+
+
+def encode_pairs(pairs, body_type):
+    '''
+    :return: generator of body chunks for (key, value) pairs
+    '''
+    for key, value in pairs:
+        if body_type == NDJSON:
+            yield json.dumps({'key': key, 'value': value}) + '\n'
+        else:
+            yield encode_frame(key) + encode_frame(value)
+
+
+def decode_pairs(stream, body_type):
+    '''
+    :return: generator of (key, value) pairs
+    '''
+    if body_type == NDJSON:
+        for pair in _iter_lines(stream):
+            yield pair['key'], pair['value']
+        return
+    frames = iter_frames(stream)
+    for key in frames:
+        try:
+            value = next(frames)
+        except StopIteration:
+            raise Exception('Key %r has no value frame' % key)
+        yield key, value
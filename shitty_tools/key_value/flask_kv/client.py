@@ -1,47 +1,284 @@
-from collections import MutableMapping
+from collections import MutableMapping, OrderedDict
 try:
     from urlparse import urljoin
 except ImportError:
     # Module was moved in Python3
     from urllib.parse import urljoin
+import json
 import requests
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from ...connection_pool import ConnectionPool
+from ..utility import chunks, update_with_set_many
+from . import bulk
 
 
 class FlaskKvDict(MutableMapping):
-    def __init__(self, kv_url, session_headers = {}, session_auth = None):
-        self.session = requests.Session()
-        self.session.headers.update(session_headers)
-        if session_auth is not None:
-            self.session.auth = session_auth
+    def __init__(self, kv_url, session_headers = {}, session_auth = None, bulk_chunk_size = 1000,
+                 max_connections = 4, compress_requests = True, min_compress_size = 1024, cache_size = 0):
+        '''
+        Dictionary interface to a flask_kv server.
+
+        Requests go out over a pool of at most max_connections sessions, so the dict can be shared
+        between threads. get_many and set_many split their keys into requests of bulk_chunk_size
+        pairs and run up to max_connections of them at once.
+
+        With cache_size, the values and ETags of up to that many recently read keys are kept. Reads
+        of a cached key send If-None-Match, and the server answers 304 with no body if the value
+        hasn't changed.
+
+        :param kv_url: base url of the kv blueprint
+        :param session_headers: headers to send with every request
+        :param session_auth: requests auth for every request
+        :param bulk_chunk_size: pairs per request from get_many and set_many
+        :param max_connections: sessions in the pool, and requests in flight at once from get_many/set_many
+        :param compress_requests: gzip request bodies of at least min_compress_size bytes
+        :param min_compress_size: smallest request body worth gzipping, in bytes
+        :param cache_size: number of values to keep for ETag revalidation. 0 turns the cache off.
+        '''
+        self.session_headers = dict(session_headers)
+        self.session_auth = session_auth
+        self.pool = ConnectionPool(self._construct_session, pool_size = max_connections,
+                                   destructor = lambda session: session.close())
         self.key_join = lambda key: urljoin(kv_url, key)
+        self.bulk_chunk_size = bulk_chunk_size
+        self.max_connections = max_connections
+        self.compress_requests = compress_requests
+        self.min_compress_size = min_compress_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = Lock()
+        self._workers = None
+        self._workers_lock = Lock()
+
+    def _construct_session(self):
+        session = requests.Session()
+        session.headers.update(self.session_headers)
+        if self.session_auth is not None:
+            session.auth = self.session_auth
+        return session
+
+    def _request(self, method, url, data = None, headers = {}, **kwargs):
+        headers = dict(headers)
+        if data is not None and self.compress_requests and len(data) >= self.min_compress_size:
+            data = bulk.gzip_bytes(data)
+            headers['Content-Encoding'] = 'gzip'
+        with self.pool.session_context() as session:
+            return session.request(method, url, data=data, headers=headers, **kwargs)
+
+    def _map(self, function, iterable):
+        # Runs function over iterable up to max_connections at a time, a batch at a time so a huge
+        # iterable is never all in memory
+        with self._workers_lock:
+            if self._workers is None:
+                self._workers = ThreadPool(self.max_connections)
+        for batch in chunks(iterable, self.max_connections):
+            if len(batch) == 1:
+                yield function(batch[0])
+                continue
+            for result in self._workers.map(function, batch):
+                yield result
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            cached = self._cache.pop(key, None)
+            if cached is not None:
+                self._cache[key] = cached
+            return cached
+
+    def _cache_put(self, key, etag, value):
+        with self._cache_lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (etag, value)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, key):
+        with self._cache_lock:
+            self._cache.pop(key, None)
 
     def __getitem__(self, key):
-        response = self.session.get(self.key_join(key))
+        headers = {}
+        cached = self._cache_get(key) if self.cache_size else None
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        response = self._request('GET', self.key_join(key), headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
         if response.status_code == 404:
+            if cached is not None:
+                self._cache_drop(key)
             raise KeyError
         elif response.status_code != 200:
             raise Exception('Expected status code 200 or 404. Received: %s' %response.status_code)
-        return response.text
+        etag = response.headers.get('ETag')
+        if self.cache_size and etag:
+            self._cache_put(key, etag, response.content)
+        return response.content
+
+    def open_value(self, key, chunk_size = 64 * 1024):
+        '''
+        Opens a value for streaming, chunk_size bytes at a time, so memory use doesn't grow with
+        the size of the value. The reader holds one of the pool's sessions until it's closed, so
+        close it, or use it in a with block.
+
+        >>> with kv_client.open_value('big_blob') as reader:
+        ...     shutil.copyfileobj(reader, outfile)
+
+        :param key: key to read
+        :param chunk_size: bytes per read off the socket
+        :return: file-like reader with read, readline and close
+        '''
+        session = self.pool.get_session()
+        try:
+            response = session.get(self.key_join(key), stream=True)
+        except Exception:
+            self.pool.release_session(session)
+            raise
+        def close():
+            response.close()
+            self.pool.release_session(session)
+        if response.status_code != 200:
+            close()
+            if response.status_code == 404:
+                raise KeyError(key)
+            raise Exception('Expected status code 200 or 404. Received: %s' % response.status_code)
+        return bulk.IterReader(response.iter_content(chunk_size), close)
 
     def __setitem__(self, key, value):
-        response = self.session.post(self.key_join(key), data=value)
+        if hasattr(value, 'read'):
+            return self.set_stream(key, value)
+        self._cache_drop(key)
+        response = self._request('POST', self.key_join(key), data=value)
+        if response.status_code != 204:
+            raise Exception('Expected status code 204. Received: %s' % response.status_code)
+
+    def set_stream(self, key, source, chunk_size = 64 * 1024):
+        '''
+        Uploads a value from a file-like object or an iterable of strings with chunked transfer
+        encoding, so it never has to be in memory all at once. Streamed uploads aren't gzipped,
+        since big blobs are usually compressed already. Setting a file-like value does the same thing.
+
+        :param key: key to write
+        :param source: object with a read method, or an iterable of strings
+        :param chunk_size: bytes to read from source at a time if it is file-like
+        '''
+        self._cache_drop(key)
+        if hasattr(source, 'read'):
+            source = bulk.iter_stream(source, chunk_size)
+        # A generator body makes requests use chunked transfer encoding
+        body = (chunk for chunk in source)
+        with self.pool.session_context() as session:
+            response = session.post(self.key_join(key), data=body)
         if response.status_code != 204:
             raise Exception('Expected status code 204. Received: %s' % response.status_code)
 
     def __delitem__(self, key):
-        response = self.session.delete(self.key_join(key))
+        self._cache_drop(key)
+        response = self._request('DELETE', self.key_join(key))
         if response.status_code != 204:
             raise Exception('Expected status code 204. Received: %s' % response.status_code)
 
     def __iter__(self):
-        response = self.session.get(self.key_join(''))
+        return self.iterkeys()
+
+    def iterkeys(self, prefix = ''):
+        '''
+        Streams the keys, optionally only the ones starting with prefix, in one request without
+        holding them all in memory. The stream gets a session of its own rather than one from the
+        pool, so other calls, get_many included, can run while it's being iterated.
+        '''
+        session = self._construct_session()
+        try:
+            response = session.get(self.key_join('_bulk/keys'), params={'prefix': prefix}, stream=True)
+            if response.status_code != 200:
+                raise Exception('Expected status code 200. Received: %s' % response.status_code)
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            session.close()
+
+    def keys_page(self, prefix = '', cursor = None, limit = 1000):
+        '''
+        One page of the keys starting with prefix, in key order. The server looks through every key
+        for each page, so iterkeys is much cheaper for going through all of them.
+
+        :param prefix: only keys starting with this
+        :param cursor: None for the first page, then the cursor returned with the page before
+        :param limit: keys per page
+        :return: (list of keys, cursor for the next page or None after the last page)
+        '''
+        params = {'prefix': prefix, 'limit': limit}
+        if cursor is not None:
+            params['cursor'] = cursor
+        response = self._request('GET', self.key_join('_bulk/keys'), params=params)
         if response.status_code != 200:
             raise Exception('Expected status code 200. Received: %s' % response.status_code)
-        for key in response.json():
-            yield key
+        page = response.json()
+        return page['keys'], page['cursor']
 
     def __len__(self):
-        response = self.session.get(self.key_join(''))
+        return self.count()
+
+    def count(self, prefix = ''):
+        '''
+        Number of keys, or of keys starting with prefix, counted by the server.
+        '''
+        response = self._request('GET', self.key_join('_bulk/count'), params={'prefix': prefix})
         if response.status_code != 200:
             raise Exception('Expected status code 200. Received: %s' % response.status_code)
-        return len(response.json())
\ No newline at end of file
+        return response.json()['count']
+
+    def _get_chunk(self, key_chunk):
+        response = self._request('POST', self.key_join('_bulk/get'),
+                                 data=b''.join(bulk.encode_keys(key_chunk, bulk.FRAMED)),
+                                 headers={'Content-Type': bulk.FRAMED})
+        if response.status_code != 200:
+            raise Exception('Expected status code 200. Received: %s' % response.status_code)
+        return dict(bulk.decode_pairs(bulk.IterReader([response.content]), bulk.FRAMED))
+
+    def get_many(self, keys):
+        '''
+        Fetches many keys, bulk_chunk_size per request and up to max_connections requests at once.
+
+        :param keys: iterable of keys
+        :return: dict of the keys that were found and their values
+        '''
+        result = {}
+        for found in self._map(self._get_chunk, chunks(keys, self.bulk_chunk_size)):
+            result.update(found)
+        return result
+
+    def _set_chunk(self, item_chunk):
+        for key, _ in item_chunk:
+            self._cache_drop(key)
+        response = self._request('POST', self.key_join('_bulk/set'),
+                                 data=b''.join(bulk.encode_pairs(item_chunk, bulk.FRAMED)),
+                                 headers={'Content-Type': bulk.FRAMED})
+        if response.status_code != 204:
+            raise Exception('Expected status code 204. Received: %s' % response.status_code)
+
+    def set_many(self, items):
+        '''
+        Writes many key-value pairs, bulk_chunk_size per request and up to max_connections requests at once.
+
+        :param items: dict or iterable of (key, value) pairs
+        '''
+        if hasattr(items, 'items'):
+            items = items.items()
+        for _ in self._map(self._set_chunk, chunks(items, self.bulk_chunk_size)):
+            pass
+
+    update = update_with_set_many
+
+    def close(self):
+        '''
+        Stops the worker threads get_many and set_many run their requests on. They're started
+        again if either is called after this.
+        '''
+        with self._workers_lock:
+            if self._workers is not None:
+                self._workers.terminate()
+                self._workers.join()
+                self._workers = None
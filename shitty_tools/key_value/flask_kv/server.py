@@ -1,37 +1,241 @@
-from flask import Flask, request, abort, Blueprint
+from flask import Flask, request, abort, Blueprint, Response
+from werkzeug.wsgi import wrap_file
+import os
 import json
+import heapq
+import hashlib
 import random
 import string
+from itertools import islice
+from ..utility import chunks
+from . import bulk
 
 
-def construct_kv_app(kv_store, url_prefix =''):
+def construct_kv_app(kv_store, url_prefix ='', **blueprint_kwargs):
     app = Flask(__name__)
-    app.register_blueprint(construct_kv_blueprint(kv_store, url_prefix))
+    app.register_blueprint(construct_kv_blueprint(kv_store, url_prefix, **blueprint_kwargs))
     return app
 
 
-def construct_kv_blueprint(kv_store, url_prefix):
+def _request_stream():
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        return bulk.IterReader(bulk.gunzip_chunks(bulk.iter_stream(request.stream)))
+    return request.stream
+
+
+def _etag(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return hashlib.md5(value).hexdigest()
+
+
+def _fileno(value_file):
+    # Only real files can be fstat'ed and sent with sendfile. Readers like FlaskKvDict's don't
+    # have a file descriptor, and some file-likes have fileno but raise when it's called.
+    try:
+        return value_file.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _file_etag(value_file):
+    # Writes that replace the file (FileSystemDict renames into place) change the inode, so this
+    # changes whenever the value does without having to read the file
+    stat = os.fstat(value_file.fileno())
+    return '%x-%x-%x' % (stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000))
+
+
+def _get_many(kv_store, keys):
+    if hasattr(kv_store, 'get_many'):
+        return kv_store.get_many(keys)
+    result = {}
+    for key in keys:
+        try:
+            result[key] = kv_store[key]
+        except KeyError:
+            pass
+    return result
+
+
+def _set_many(kv_store, items):
+    if hasattr(kv_store, 'set_many'):
+        return kv_store.set_many(items)
+    for key, value in items:
+        kv_store[key] = value
+
+
+def construct_kv_blueprint(kv_store, url_prefix, bulk_chunk_size = 1000, compress_responses = True,
+                           min_compress_size = 1024, etags = True):
+    '''
+    :param kv_store: Something that presents a dictionary interface
+    :param url_prefix: The sub-path to use for the key value store
+    :param bulk_chunk_size: keys per call to the store's get_many/set_many from the bulk endpoints
+    :param compress_responses: gzip responses for clients that accept it
+    :param min_compress_size: smallest single value worth gzipping, in bytes. Streamed responses are
+     always gzipped when compress_responses is on.
+    :param etags: tag single key reads with an ETag (an md5 of the value) and answer a matching
+     If-None-Match with 304
+    :return: the blueprint
+    '''
     random_string = ''.join(random.sample(string.ascii_letters, 10))
     blueprint = Blueprint('kv_%s' % random_string, __name__, url_prefix=url_prefix)
 
+    def respond(body, mimetype, status = 200):
+        # body is a string, or an iterable of strings to stream
+        accepts_gzip = compress_responses and 'gzip' in request.accept_encodings
+        headers = {'Vary': 'Accept-Encoding'}
+        if accepts_gzip and (not isinstance(body, basestring) or len(body) >= min_compress_size):
+            headers['Content-Encoding'] = 'gzip'
+            body = bulk.gzip_chunks([body] if isinstance(body, basestring) else body)
+        return Response(body, status=status, mimetype=mimetype, headers=headers)
+
 
     @blueprint.route('/', methods=['GET'])
     def get_keys():
-        return json.dumps(kv_store.keys())
+        # Streamed, so the key list never has to be in memory all at once
+        def generate():
+            yield '['
+            separator = ''
+            for key_chunk in chunks(kv_store, bulk_chunk_size):
+                yield separator + ','.join(json.dumps(key) for key in key_chunk)
+                separator = ','
+            yield ']'
+        return respond(generate(), 'application/json')
+
+
+    # Bulk endpoints live under /_bulk/, which can't be mistaken for a key since keys can't contain '/'
+
+    @blueprint.route('/_bulk/keys', methods=['GET'])
+    def list_keys():
+        '''
+        Keys that start with prefix. With limit, a JSON page of the first limit keys (in key order)
+        after cursor, plus the cursor for the next page, which is null on the last page.
+        Without limit, every key streamed as NDJSON in whatever order the store iterates.
+        '''
+        prefix = request.args.get('prefix', '')
+        after = request.args.get('cursor')
+        limit = request.args.get('limit', type=int)
+        matching = (key for key in kv_store if key.startswith(prefix) and (after is None or key > after))
+        if limit is None:
+            return respond((''.join(bulk.encode_keys(key_chunk, bulk.NDJSON))
+                            for key_chunk in chunks(matching, bulk_chunk_size)),
+                           bulk.NDJSON)
+        # Only limit + 1 keys are held at a time, however big the store is
+        page = heapq.nsmallest(limit + 1, matching)
+        cursor = page[limit - 1] if len(page) > limit and limit > 0 else None
+        return respond(json.dumps({'keys': page[:limit], 'cursor': cursor}), 'application/json')
+
+
+    @blueprint.route('/_bulk/count', methods=['GET'])
+    def count_keys():
+        '''
+        Number of keys that start with prefix. Without a prefix this is len() of the store.
+        '''
+        prefix = request.args.get('prefix', '')
+        if prefix:
+            count = sum(1 for key in kv_store if key.startswith(prefix))
+        else:
+            count = len(kv_store)
+        return respond(json.dumps({'count': count}), 'application/json')
+
+
+    @blueprint.route('/_bulk/stats', methods=['GET'])
+    def stats():
+        '''
+        The store's snapshot() as JSON, for stores that keep stats (like InstrumentedDict). 404 otherwise.
+        '''
+        if not hasattr(kv_store, 'snapshot'):
+            abort(404)
+        return respond(json.dumps(kv_store.snapshot(hot_keys=request.args.get('hot_keys', 20, type=int))),
+                       'application/json')
+
+
+    @blueprint.route('/_bulk/get', methods=['POST'])
+    def multi_read():
+        '''
+        Takes keys as NDJSON or frames, depending on Content-Type, and streams back the pairs that were
+        found in the same format.
+        '''
+        body_type = bulk.body_format(request.content_type)
+        keys = list(bulk.decode_keys(_request_stream(), body_type))
+        def generate():
+            for key_chunk in chunks(keys, bulk_chunk_size):
+                found = _get_many(kv_store, key_chunk)
+                yield ''.join(bulk.encode_pairs(((key, found[key]) for key in key_chunk if key in found),
+                                                body_type))
+        return respond(generate(), body_type)
+
+
+    @blueprint.route('/_bulk/set', methods=['POST'])
+    def multi_write():
+        '''
+        Takes pairs as NDJSON or frames, depending on Content-Type, and writes them bulk_chunk_size at a
+        time as they're read off the request.
+        '''
+        body_type = bulk.body_format(request.content_type)
+        pairs = bulk.decode_pairs(_request_stream(), body_type)
+        while True:
+            item_chunk = list(islice(pairs, bulk_chunk_size))
+            if not item_chunk:
+                break
+            _set_many(kv_store, item_chunk)
+        return ('', 204)
 
 
     @blueprint.route('/<string:key>', methods=['POST','PUT','PATCH'])
     def write(key):
-        kv_store[key] = request.data
+        if hasattr(kv_store, 'set_stream'):
+            # Straight from the socket into the store, however big the value is
+            kv_store.set_stream(key, _request_stream())
+        else:
+            kv_store[key] = _request_stream().read()
         return ('', 204)
 
+    def read_file(value_file):
+        if _fileno(value_file) is None:
+            # Some other file-like value. Stream it, but there's no cheap way to tag it.
+            response = respond(bulk.iter_stream(value_file), 'application/octet-stream')
+            if hasattr(value_file, 'close'):
+                response.call_on_close(value_file.close)
+            return response
+        # The file goes out through the server's wsgi.file_wrapper, which is sendfile where the
+        # server supports it, so it isn't gzipped
+        etag = _file_etag(value_file) if etags else None
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            value_file.close()
+            response = Response(status=304)
+        else:
+            response = Response(wrap_file(request.environ, value_file), mimetype='application/octet-stream',
+                                direct_passthrough=True)
+            response.content_length = os.fstat(value_file.fileno()).st_size
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
+
     @blueprint.route('/<string:key>', methods=['GET'])
     def read(key):
+        if hasattr(kv_store, 'open_value'):
+            try:
+                value_file = kv_store.open_value(key)
+            except KeyError:
+                abort(404)
+            return read_file(value_file)
         try:
             value = kv_store[key]
         except KeyError:
             abort(404)
-        return value
+        if hasattr(value, 'read'):
+            return read_file(value)
+        if not etags:
+            return respond(value, None)
+        etag = _etag(value)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = respond(value, None)
+        # Weak, since the same value is sent gzipped to some clients and not to others
+        response.set_etag(etag, weak=True)
+        return response
 
     @blueprint.route('/<string:key>', methods=['DELETE'])
     def delete(key):
@@ -41,4 +245,4 @@ def construct_kv_blueprint(kv_store, url_prefix):
             pass
         return ('', 204)
 
-    return blueprint
\ No newline at end of file
+    return blueprint
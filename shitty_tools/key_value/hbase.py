@@ -1,98 +1,440 @@
 from collections import MutableMapping
 from contextlib import contextmanager
+from .utility import chunks, update_with_set_many
 
 
 # TODO: Documentation
 
+# Scans that only need row keys. Every row comes back with a single empty cell.
+KEY_ONLY_FILTER = 'KeyOnlyFilter()'
+ROW_KEY_ONLY_FILTER = 'FirstKeyOnlyFilter() AND KeyOnlyFilter()'
+
+
 class HbaseDictBase(MutableMapping):
-    def __init__(self, connection_pool, table_name):
+    def __init__(self, connection_pool, table_name, batch_size = 1000):
         self.pool = connection_pool
         self.table_name = table_name
+        # Rows per rows() call, mutations per batch send and rows per scanner round-trip
+        self.batch_size = batch_size
 
     @contextmanager
     def table_ctx(self):
         with self.pool.connection() as conn:
             yield conn.table(self.table_name)
 
+    update = update_with_set_many
+
 
 class HbaseRowDict(HbaseDictBase):
-    def __init__(self, connection_pool, table_name, column_family, row_key):
-        super(HbaseRowDict, self).__init__(connection_pool, table_name)
+    def __init__(self, connection_pool, table_name, column_family, row_key, batch_size = 1000, prefetch = False,
+                 row_data = None, on_write = None):
+        '''
+        Dictionary access to the columns of one row in one column family. Keyed on column name.
+
+        Normally every access is its own call to HBase. With prefetch, the whole column family of the
+        row is fetched once, on first read, and reads are served from that snapshot. Writes and deletes
+        are buffered (and show up in the snapshot straight away) until flush() is called or a with
+        block around the dict exits cleanly, then go out together in one call.
+
+        >>> with HbaseRowDict(pool, 'table', 'cf', 'row', prefetch=True) as row:
+        ...     row['count'] = str(int(row['count']) + 1)
+
+        :param connection_pool: happybase connection pool
+        :param table_name: table the row is in
+        :param column_family: column family to expose
+        :param row_key: row to expose
+        :param batch_size: unused by a single row, kept for HbaseDictBase
+        :param prefetch: serve reads from a snapshot of the row and buffer writes
+        :param row_data: the row as returned by happybase, if it has already been fetched. Implies prefetch.
+        :param on_write: called with this dict whenever a write or delete is buffered
+        '''
+        super(HbaseRowDict, self).__init__(connection_pool, table_name, batch_size)
         self.row_key = row_key
         self.column_family = column_family
         self.key_join = lambda key: ':'.join([column_family, key])
-        self.key_strip = lambda fullkey: fullkey.lstrip(column_family + ':')
+        self.key_strip = lambda fullkey: fullkey[len(column_family) + 1:]
+        self.prefetch = prefetch or row_data is not None
+        self._snapshot = self._strip_row(row_data) if row_data is not None else None
+        self._pending_puts = {}
+        self._pending_deletes = set()
+        self._on_write = on_write
+
+    def _strip_row(self, row):
+        return {self.key_strip(fullkey): value for fullkey, value in row.items()}
+
+    def _fetch(self):
+        with self.table_ctx() as table:
+            return table.row(self.row_key, (self.column_family,))
+
+    def _fetch_keys(self):
+        # row() has no filter, so scan just this row to get the column names without the values
+        with self.table_ctx() as table:
+            for _, row in table.scan(row_start=self.row_key, row_stop=self.row_key + '\0',
+                                     columns=(self.column_family,), filter=KEY_ONLY_FILTER, limit=1):
+                return [self.key_strip(fullkey) for fullkey in row]
+        return []
+
+    def _get_snapshot(self):
+        if self._snapshot is None:
+            snapshot = self._strip_row(self._fetch())
+            # Writes buffered before the first read win over what's stored
+            snapshot.update(self._pending_puts)
+            for key in self._pending_deletes:
+                snapshot.pop(key, None)
+            self._snapshot = snapshot
+        return self._snapshot
+
+    def refresh(self):
+        '''
+        Throws away the snapshot so the next read fetches the row again. Buffered writes are kept.
+        '''
+        self._snapshot = None
+
+    def flush(self):
+        '''
+        Sends buffered writes and deletes to HBase in one call.
+        '''
+        puts, deletes = self._take_pending()
+        if not puts and not deletes:
+            return
+        with self.table_ctx() as table:
+            with table.batch() as batch:
+                self._add_to_batch(batch, puts, deletes)
+
+    def _take_pending(self):
+        puts, deletes = self._pending_puts, self._pending_deletes
+        self._pending_puts = {}
+        self._pending_deletes = set()
+        return puts, deletes
+
+    def _add_to_batch(self, batch, puts, deletes):
+        # Deletes and puts are never for the same column, so sharing a timestamp is fine
+        if deletes:
+            batch.delete(self.row_key, [self.key_join(key) for key in deletes])
+        if puts:
+            batch.put(self.row_key, {self.key_join(key): value for key, value in puts.items()})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
 
     def __getitem__(self, key):
+        if self.prefetch:
+            return self._get_snapshot()[key]
         fullkey = self.key_join(key)
         with self.table_ctx() as table:
             return table.row(self.row_key, (fullkey,))[fullkey]
 
     def __setitem__(self, key, value):
+        if self.prefetch:
+            return self.set_many([(key, value)])
         fullkey = self.key_join(key)
         with self.table_ctx() as table:
             table.put(self.row_key, {fullkey: value})
 
     def __delitem__(self, key):
+        if self.prefetch:
+            return self.delete_many([key])
         fullkey = self.key_join(key)
         with self.table_ctx() as table:
             table.delete(self.row_key, (fullkey,))
 
     def __iter__(self):
-        with self.table_ctx() as table:
-            for key in table.row(self.row_key):
-                if key.startswith(self.column_family):
-                    yield self.key_strip(key)
+        if self.prefetch:
+            row = list(self._get_snapshot())
+        else:
+            row = self._fetch_keys()
+        for key in row:
+            yield key
 
     def __len__(self):
+        if self.prefetch:
+            return len(self._get_snapshot())
+        return len(self._fetch_keys())
+
+    def get_many(self, keys):
+        '''
+        Reads many columns of the row in one call.
+
+        :param keys: iterable of column names
+        :return: dict of the columns that were found and their values
+        '''
+        if self.prefetch:
+            snapshot = self._get_snapshot()
+            return {key: snapshot[key] for key in keys if key in snapshot}
+        fullkeys = [self.key_join(key) for key in keys]
+        if not fullkeys:
+            return {}
         with self.table_ctx() as table:
-            return len(filter(lambda k: k.startswith(self.column_family), table.row(self.row_key)))
+            row = table.row(self.row_key, fullkeys)
+        return self._strip_row(row)
+
+    def set_many(self, items):
+        '''
+        Writes many columns of the row in one put.
+
+        :param items: dict or iterable of (column name, value) pairs
+        '''
+        if hasattr(items, 'items'):
+            items = items.items()
+        if self.prefetch:
+            for key, value in items:
+                self._pending_puts[key] = value
+                self._pending_deletes.discard(key)
+                if self._snapshot is not None:
+                    self._snapshot[key] = value
+            if self._on_write is not None:
+                self._on_write(self)
+            return
+        data = {self.key_join(key): value for key, value in items}
+        if data:
+            with self.table_ctx() as table:
+                table.put(self.row_key, data)
+
+    def delete_many(self, keys):
+        '''
+        Deletes many columns of the row in one call. Missing columns are ignored.
+
+        :param keys: iterable of column names
+        '''
+        if self.prefetch:
+            for key in keys:
+                self._pending_puts.pop(key, None)
+                self._pending_deletes.add(key)
+                if self._snapshot is not None:
+                    self._snapshot.pop(key, None)
+            if self._on_write is not None:
+                self._on_write(self)
+            return
+        fullkeys = [self.key_join(key) for key in keys]
+        if fullkeys:
+            with self.table_ctx() as table:
+                table.delete(self.row_key, fullkeys)
 
     def __str__(self):
         return str(self.items())
 
 
 class HbaseCfDict(HbaseDictBase):
-    def __init__(self, connection_pool, table_name, column_family):
-        super(HbaseCfDict, self).__init__(connection_pool, table_name)
+    def __init__(self, connection_pool, table_name, column_family, batch_size = 1000, prefetch = False):
+        '''
+        Dictionary access to a column family. Keyed on row key, with each row an HbaseRowDict.
+        Setting a row replaces everything in the column family of that row.
+
+        Replacing a row takes a read of its columns and then a batch, so two calls. With prefetch,
+        row replacements and deletes are buffered until flush() is called or a with block around the
+        dict exits cleanly, then sent batch_size rows per call.
+        Rows handed out are prefetched HbaseRowDicts (see HbaseRowDict), and iterating items() or
+        values() fetches rows batch_size at a time with a scan instead of one call per row. Writes
+        to rows handed out are buffered too, and flushing this dict sends them along with its own,
+        in one batch. Iteration and len() only see rows that have been flushed.
+
+        Every write takes the server's timestamp. HBase masks a put with a delete of the same
+        timestamp, so a row deleted and set again within the same millisecond may stay deleted.
+
+        :param connection_pool: happybase connection pool
+        :param table_name: table the column family is in
+        :param column_family: column family to expose
+        :param batch_size: rows per rows() call, mutations per batch send and rows per scanner round-trip
+        :param prefetch: buffer row writes, and hand out rows that are fetched once and buffer their writes
+        '''
+        super(HbaseCfDict, self).__init__(connection_pool, table_name, batch_size)
         self.column_family = column_family
         self.key_join = lambda key: ':'.join([column_family, key])
-        self.key_strip = lambda fullkey: fullkey.lstrip(column_family + ':')
+        self.key_strip = lambda fullkey: fullkey[len(column_family) + 1:]
+        self.prefetch = prefetch
+        # Row key to the row's new columns, or None for a delete
+        self._pending_rows = {}
+        # Row key to the handed out rows with buffered writes, in the order they were first written
+        self._edited_rows = {}
+
+    def _row_edited(self, row):
+        rows = self._edited_rows.setdefault(row.row_key, [])
+        if not any(edited is row for edited in rows):
+            rows.append(row)
+
+    def _discard_row_edits(self, rowkey):
+        # Replacing or deleting the whole row supersedes anything buffered on rows handed out before
+        for row in self._edited_rows.pop(rowkey, []):
+            row._take_pending()
+
+    def flush(self):
+        '''
+        Sends buffered row replacements and deletes to HBase, along with the buffered writes of rows
+        handed out.
+        '''
+        pending_rows, self._pending_rows = self._pending_rows, {}
+        edited_rows, self._edited_rows = self._edited_rows, {}
+        column_edits = []
+        for rowkey, rows in edited_rows.items():
+            puts, deletes = {}, set()
+            for row in rows:
+                row_puts, row_deletes = row._take_pending()
+                for key in row_deletes:
+                    puts.pop(key, None)
+                    deletes.add(key)
+                for key, value in row_puts.items():
+                    deletes.discard(key)
+                    puts[key] = value
+            if rowkey in pending_rows:
+                # Rows handed out after a buffered replacement or delete edit the new value
+                value = dict(pending_rows[rowkey] or {})
+                value.update(puts)
+                for key in deletes:
+                    value.pop(key, None)
+                pending_rows[rowkey] = value
+            elif puts or deletes:
+                column_edits.append((rows[0], puts, deletes))
+        self._write_rows([(rowkey, value) for rowkey, value in pending_rows.items() if value is not None])
+        self._delete_rows([rowkey for rowkey, value in pending_rows.items() if value is None])
+        if column_edits:
+            with self.table_ctx() as table:
+                with table.batch(batch_size=self.batch_size) as batch:
+                    for row, puts, deletes in column_edits:
+                        row._add_to_batch(batch, puts, deletes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def _row_dict(self, rowkey, row_data = None):
+        return HbaseRowDict(self.pool, self.table_name, self.column_family, rowkey, self.batch_size,
+                            self.prefetch, row_data, self._row_edited if self.prefetch else None)
 
     def __getitem__(self, rowkey):
-        return HbaseRowDict(self.pool, self.table_name, self.column_family, rowkey)
+        if rowkey in self._pending_rows:
+            # Buffered, so nothing to fetch
+            value = self._pending_rows[rowkey] or {}
+            return self._row_dict(rowkey, {self.key_join(key): cell_val for key, cell_val in value.items()})
+        return self._row_dict(rowkey)
 
     def __setitem__(self, rowkey, value):
         # TODO: Locking?
-        with self.table_ctx() as table:
-            # We can't do a batch here because delete and set behaviour is weird in HBase.
-            # See: https://hbase.apache.org/book.html#_current_limitations
-            table.delete(rowkey)
-            table.put(rowkey, {self.key_join(key): cell_val for (key, cell_val) in value.items()})
+        self.set_many([(rowkey, value)])
 
     def __delitem__(self, rowkey):
-        with self.table_ctx() as table:
-            table.delete(rowkey)
+        self.delete_many([rowkey])
 
     def __iter__(self):
         with self.table_ctx() as table:
-            for rowkey, _ in table.scan():
+            for rowkey, _ in table.scan(columns=(self.column_family,), filter=ROW_KEY_ONLY_FILTER,
+                                        batch_size=self.batch_size):
                 yield rowkey
 
     def __len__(self):
         # Meh. Looks like there's no obvious way to get this without a full table scan. Have fun.
+        # At least it's only the row keys coming back.
         n = -1
-        with self.table_ctx() as table:
-            for n, _ in enumerate(table.scan()): pass
+        for n, _ in enumerate(self.__iter__()): pass
         return n + 1
 
+    def iteritems(self):
+        if not self.prefetch:
+            for rowkey in self:
+                yield rowkey, self[rowkey]
+            return
+        with self.table_ctx() as table:
+            for rowkey, row in table.scan(columns=(self.column_family,), batch_size=self.batch_size):
+                yield rowkey, self._row_dict(rowkey, row)
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get_many(self, rowkeys):
+        '''
+        Reads the column family of many rows with one rows() call per batch_size rows.
+
+        :param rowkeys: iterable of row keys
+        :return: dict of the rows that have columns in the family, each a dict of column name to value
+        '''
+        result = {}
+        with self.table_ctx() as table:
+            for rowkey_chunk in chunks(rowkeys, self.batch_size):
+                for rowkey, row in table.rows(rowkey_chunk, (self.column_family,)):
+                    result[rowkey] = {self.key_strip(fullkey): value for fullkey, value in row.items()}
+        return result
+
+    def set_many(self, items):
+        '''
+        Replaces the column family of many rows. For every batch_size rows, the columns they have
+        now are read with one rows() call, then the columns to drop and the new ones are sent in one
+        batch. Columns another writer adds between the read and the batch are left alone. With
+        prefetch the rows are buffered until flush.
+
+        :param items: dict or iterable of (row key, dict of column name to value) pairs
+        '''
+        if hasattr(items, 'items'):
+            items = items.items()
+        if self.prefetch:
+            for rowkey, value in items:
+                self._discard_row_edits(rowkey)
+                self._pending_rows[rowkey] = dict(value)
+            return
+        self._write_rows(list(items))
+
+    def _write_rows(self, items):
+        # The last write to a row wins
+        rows = dict(items)
+        if not rows:
+            return
+        # A delete masks puts with the same timestamp or older, whichever is sent first, so deleting
+        # the column family and putting the new columns can't share a timestamp. Rather than stamping
+        # them from the client clock, which goes wrong as soon as clocks drift apart, the columns the
+        # row has now are read and only the ones the new value doesn't have are deleted. The deletes
+        # and puts are then for different columns and go out together with the server's timestamp.
+        # See: https://hbase.apache.org/book.html#_current_limitations
+        with self.table_ctx() as table:
+            for rowkey_chunk in chunks(rows, self.batch_size):
+                existing = dict(table.rows(rowkey_chunk, (self.column_family,)))
+                with table.batch() as batch:
+                    for rowkey in rowkey_chunk:
+                        data = {self.key_join(key): cell_val for (key, cell_val) in rows[rowkey].items()}
+                        stale = [fullkey for fullkey in existing.get(rowkey, {}) if fullkey not in data]
+                        if stale:
+                            batch.delete(rowkey, stale)
+                        if data:
+                            batch.put(rowkey, data)
+
+    def delete_many(self, rowkeys):
+        '''
+        Deletes the column family of many rows in batches of batch_size mutations. Missing rows are ignored.
+        With prefetch they're buffered until flush.
+
+        :param rowkeys: iterable of row keys
+        '''
+        if self.prefetch:
+            for rowkey in rowkeys:
+                self._discard_row_edits(rowkey)
+                self._pending_rows[rowkey] = None
+            return
+        self._delete_rows(rowkeys)
+
+    def _delete_rows(self, rowkeys):
+        with self.table_ctx() as table:
+            with table.batch(batch_size=self.batch_size) as batch:
+                for rowkey in rowkeys:
+                    batch.delete(rowkey, (self.column_family,))
+
     def __str__(self):
         return str(self.items())
 
 
 
 class HbaseValueDict(MutableMapping):
-    def __init__(self, connection_pool, table_name, value_column):
+    def __init__(self, connection_pool, table_name, value_column, batch_size = 1000):
         '''
         Takes a happybase connection pool, a table name, and the name of a value column
         and provides a key-value store interface to the HBase column.
@@ -129,6 +471,10 @@ class HbaseValueDict(MutableMapping):
         'bar'
 
 
+        get_many, set_many and delete_many move batch_size rows per Thrift call. Iteration and
+        len scan batch_size row keys per call, without the values.
+
+
         This does not *currently* support handling broken connections. It is planned.
         Currently behaviour follows underlying happybase behaviour--
         https://happybase.readthedocs.io/en/latest/user.html#handling-broken-connections      
@@ -136,6 +482,7 @@ class HbaseValueDict(MutableMapping):
         self.pool = connection_pool
         self.value_column = value_column
         self.table_name = table_name
+        self.batch_size = batch_size
 
     def __getitem__(self, key):
         with self.pool.connection() as conn:
@@ -148,7 +495,9 @@ class HbaseValueDict(MutableMapping):
 
     def __iter__(self):
         with self.pool.connection() as conn:
-            for rowkey, rowdata in conn.table(self.table_name).scan(columns=(self.value_column,)):
+            for rowkey, rowdata in conn.table(self.table_name).scan(columns=(self.value_column,),
+                                                                    filter=KEY_ONLY_FILTER,
+                                                                    batch_size=self.batch_size):
                 try:
                     _ = rowdata[self.value_column]
                     yield rowkey
@@ -170,3 +519,62 @@ class HbaseValueDict(MutableMapping):
     def __delitem__(self, key):
         with self.pool.connection() as conn:
             conn.table(self.table_name).delete(key, (self.value_column,))
+
+    def get_many(self, keys):
+        '''
+        Reads many keys with one rows() call per batch_size keys.
+
+        :param keys: iterable of keys
+        :return: dict of the keys that were found and their values
+        '''
+        result = {}
+        with self.pool.connection() as conn:
+            table = conn.table(self.table_name)
+            for key_chunk in chunks(keys, self.batch_size):
+                for rowkey, rowdata in table.rows(key_chunk, (self.value_column,)):
+                    if self.value_column in rowdata:
+                        result[rowkey] = rowdata[self.value_column]
+        return result
+
+    def set_many(self, items):
+        '''
+        Writes many key-value pairs in batches of batch_size puts.
+
+        :param items: dict or iterable of (key, value) pairs
+        '''
+        if hasattr(items, 'items'):
+            items = items.items()
+        with self.pool.connection() as conn:
+            with conn.table(self.table_name).batch(batch_size=self.batch_size) as batch:
+                for key, value in items:
+                    batch.put(key, {self.value_column: value})
+
+    def delete_many(self, keys):
+        '''
+        Deletes many keys in batches of batch_size deletes. Missing keys are ignored.
+
+        :param keys: iterable of keys
+        '''
+        with self.pool.connection() as conn:
+            with conn.table(self.table_name).batch(batch_size=self.batch_size) as batch:
+                for key in keys:
+                    batch.delete(key, (self.value_column,))
+
+    update = update_with_set_many
+
+    def iteritems(self):
+        with self.pool.connection() as conn:
+            for rowkey, rowdata in conn.table(self.table_name).scan(columns=(self.value_column,),
+                                                                    batch_size=self.batch_size):
+                if self.value_column in rowdata:
+                    yield rowkey, rowdata[self.value_column]
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
@@ -0,0 +1,404 @@
+import os
+import re
+import struct
+import threading
+from zlib import crc32
+from collections import MutableMapping
+from ..concurrent import construct_periodic_thread
+from .filesystem import fsync_dir
+
+
+# Record: crc32, flags, key length, value length, key, value. The crc covers everything after itself.
+_RECORD_HEADER = struct.Struct('>IBII')
+# Hint entry: flags, key length, record length, record offset, key
+_HINT_HEADER = struct.Struct('>BIIQ')
+_TOMBSTONE = 1
+
+_SEGMENT_RE = re.compile(r'^(\d{10})\.data$')
+_MERGED_RE = re.compile(r'^(\d{10})-(\d{10})\.merged$')
+
+
+def _encode_record(key, value, flags):
+    body = _RECORD_HEADER.pack(0, flags, len(key), len(value))[4:] + key + value
+    return struct.pack('>I', crc32(body) & 0xffffffff) + body
+
+
+def _decode_record(record):
+    '''
+    :return: (flags, key, value) or None if the record is truncated or fails its checksum
+    '''
+    if len(record) < _RECORD_HEADER.size:
+        return None
+    crc, flags, key_length, value_length = _RECORD_HEADER.unpack_from(record)
+    if len(record) != _RECORD_HEADER.size + key_length + value_length:
+        return None
+    if crc32(record[4:]) & 0xffffffff != crc:
+        return None
+    key_start = _RECORD_HEADER.size
+    return flags, record[key_start:key_start + key_length], record[key_start + key_length:]
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class PackFileDict(MutableMapping):
+    def __init__(self, storage_path, max_segment_size = 64 * 1024 * 1024, sync_writes = False):
+        '''
+        Log structured key-value store in the style of bitcask. Every write is appended to the
+        active segment file in storage_path and an in-memory key directory maps each key to the
+        segment, offset and length of its latest record, so a read is a single positioned read.
+        Overwritten and deleted records stay on disk until compact is called, either directly
+        or from the thread started by start_compaction.
+
+        Each record carries a checksum. A write that was torn by a crash fails the checksum and
+        is discarded when the store is reopened, so each write is atomic in the same sense as a
+        FileSystemDict rename. Pass sync_writes = True to fsync after every write if writes also
+        need to survive power loss.
+
+        When a segment fills up a hint file is written next to it holding just the keys and
+        record locations, so reopening a store reads the hint files rather than every value.
+
+        Only one PackFileDict may have a storage path open at a time. It is thread safe.
+
+        :param storage_path: directory for segment and hint files
+        :param max_segment_size: size in bytes at which the active segment is closed and a new one started
+        :param sync_writes: fsync the active segment after each write
+        '''
+        self.storage_path = os.path.abspath(storage_path)
+        self.max_segment_size = max_segment_size
+        self.sync_writes = sync_writes
+        if not os.path.isdir(self.storage_path):
+            os.makedirs(self.storage_path)
+
+        self._lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+        self._keydir = {}
+        self._segment_sizes = {}
+        self._dead_bytes = {}
+        self._read_handles = {}
+        self._retired_fds = []
+        self._closed = False
+        self._compaction_stop = threading.Event()
+        self._compaction_thread = None
+
+        self._recover_merges()
+        for segment_id in self._list_segment_ids():
+            self._load_segment(segment_id)
+            self._read_handles[segment_id] = (self._open_read_fd(segment_id), threading.Lock())
+        self._start_segment(max(self._segment_sizes.keys() or [0]) + 1)
+
+
+    def _segment_path(self, segment_id, extension = 'data'):
+        return os.path.join(self.storage_path, '%010d.%s' % (segment_id, extension))
+
+
+    def _list_segment_ids(self):
+        return sorted(int(match.group(1)) for match in map(_SEGMENT_RE.match, os.listdir(self.storage_path))
+                      if match)
+
+
+    def _open_read_fd(self, segment_id):
+        return os.open(self._segment_path(segment_id), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+
+    def _recover_merges(self):
+        # A .merged file is a compaction that committed but may not have finished swapping files.
+        # Anything else left over from a compaction never committed and is thrown away.
+        filenames = os.listdir(self.storage_path)
+        for filename in filenames:
+            match = _MERGED_RE.match(filename)
+            if match:
+                self._finish_merge_files(int(match.group(1)), int(match.group(2)))
+        for filename in os.listdir(self.storage_path):
+            if filename.endswith('.merge') or filename.endswith('.merge-hint') or filename.endswith('.tmp'):
+                os.remove(os.path.join(self.storage_path, filename))
+
+
+    def _merge_path(self, first_id, last_id, extension):
+        return os.path.join(self.storage_path, '%010d-%010d.%s' % (first_id, last_id, extension))
+
+
+    def _finish_merge_files(self, first_id, last_id):
+        for segment_id in self._list_segment_ids():
+            if first_id <= segment_id <= last_id:
+                for extension in ('hint', 'data'):
+                    try:
+                        os.remove(self._segment_path(segment_id, extension))
+                    except OSError:
+                        pass
+        hint_path = self._merge_path(first_id, last_id, 'merge-hint')
+        if os.path.exists(hint_path):
+            os.rename(hint_path, self._segment_path(last_id, 'hint'))
+        os.rename(self._merge_path(first_id, last_id, 'merged'), self._segment_path(last_id))
+        fsync_dir(self.storage_path)
+
+
+    def _apply_entry(self, segment_id, key, flags, offset, length):
+        old_entry = self._keydir.pop(key, None)
+        if old_entry is not None:
+            self._dead_bytes[old_entry[0]] += old_entry[2]
+        if flags & _TOMBSTONE:
+            self._dead_bytes[segment_id] += length
+        else:
+            self._keydir[key] = (segment_id, offset, length)
+
+
+    def _load_segment(self, segment_id):
+        self._dead_bytes[segment_id] = 0
+        self._segment_sizes[segment_id] = os.path.getsize(self._segment_path(segment_id))
+        try:
+            with open(self._segment_path(segment_id, 'hint'), 'rb') as infile:
+                hints = infile.read()
+        except IOError:
+            self._scan_segment(segment_id)
+            return
+        position = 0
+        while position < len(hints):
+            flags, key_length, length, offset = _HINT_HEADER.unpack_from(hints, position)
+            position += _HINT_HEADER.size
+            key = hints[position:position + key_length]
+            position += key_length
+            self._apply_entry(segment_id, key, flags, offset, length)
+
+
+    def _scan_segment(self, segment_id):
+        hint_entries = {}
+        offset = 0
+        with open(self._segment_path(segment_id), 'rb') as infile:
+            while True:
+                header = infile.read(_RECORD_HEADER.size)
+                if not header:
+                    break
+                if len(header) < _RECORD_HEADER.size:
+                    decoded = None
+                else:
+                    _, _, key_length, value_length = _RECORD_HEADER.unpack(header)
+                    record = header + infile.read(key_length + value_length)
+                    decoded = _decode_record(record)
+                if decoded is None:
+                    break
+                flags, key, _ = decoded
+                self._apply_entry(segment_id, key, flags, offset, len(record))
+                hint_entries[key] = (flags, offset, len(record))
+                offset += len(record)
+        if offset < self._segment_sizes[segment_id]:
+            # Torn write from a crash. Drop it.
+            with open(self._segment_path(segment_id), 'r+b') as outfile:
+                outfile.truncate(offset)
+            self._segment_sizes[segment_id] = offset
+        self._write_hint_file(self._segment_path(segment_id, 'hint'), hint_entries)
+
+
+    def _write_hint_file(self, path, hint_entries):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            for key, (flags, offset, length) in hint_entries.iteritems():
+                outfile.write(_HINT_HEADER.pack(flags, len(key), length, offset) + key)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(tmp_path, path)
+
+
+    def _start_segment(self, segment_id):
+        self._active_id = segment_id
+        self._active_fd = os.open(self._segment_path(segment_id),
+                                  os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+        self._active_hints = {}
+        self._segment_sizes[segment_id] = 0
+        self._dead_bytes[segment_id] = 0
+        self._read_handles[segment_id] = (self._open_read_fd(segment_id), threading.Lock())
+
+
+    def _roll_segment(self):
+        # Called with self._lock held
+        os.fsync(self._active_fd)
+        os.close(self._active_fd)
+        self._write_hint_file(self._segment_path(self._active_id, 'hint'), self._active_hints)
+        self._start_segment(self._active_id + 1)
+
+
+    def _append(self, key, value, flags):
+        record = _encode_record(key, value, flags)
+        with self._lock:
+            if flags & _TOMBSTONE and key not in self._keydir:
+                raise KeyError(key)
+            if self._segment_sizes[self._active_id] >= self.max_segment_size:
+                self._roll_segment()
+            offset = self._segment_sizes[self._active_id]
+            _write_all(self._active_fd, record)
+            if self.sync_writes:
+                os.fsync(self._active_fd)
+            self._segment_sizes[self._active_id] += len(record)
+            self._apply_entry(self._active_id, key, flags, offset, len(record))
+            self._active_hints[key] = (flags, offset, len(record))
+
+
+    def _pread(self, read_handle, length, offset):
+        fd, fd_lock = read_handle
+        if hasattr(os, 'pread'):
+            return os.pread(fd, length, offset)
+        with fd_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+
+    def __getitem__(self, key):
+        # If compaction swaps the segment out from under us between the lookup and the read,
+        # the checksum or key won't match and the second attempt sees the new location.
+        for _ in range(2):
+            with self._lock:
+                entry = self._keydir.get(key)
+                if entry is None:
+                    raise KeyError(key)
+                read_handle = self._read_handles[entry[0]]
+            try:
+                decoded = _decode_record(self._pread(read_handle, entry[2], entry[1]))
+            except OSError:
+                decoded = None
+            if decoded is not None and decoded[1] == key:
+                return decoded[2]
+        raise Exception('Unable to read a valid record for key: %s' % key)
+
+
+    def __setitem__(self, key, value):
+        self._append(key, value, 0)
+
+
+    def __delitem__(self, key):
+        self._append(key, '', _TOMBSTONE)
+
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._keydir)
+        for key in keys:
+            yield key
+
+
+    def __len__(self):
+        return len(self._keydir)
+
+
+    def __contains__(self, key):
+        return key in self._keydir
+
+
+    def dead_fraction(self):
+        '''
+        :return: fraction of the bytes in closed segments taken up by overwritten or deleted records
+        '''
+        with self._lock:
+            segment_ids = [segment_id for segment_id in self._segment_sizes if segment_id != self._active_id]
+            total = sum(self._segment_sizes[segment_id] for segment_id in segment_ids)
+            dead = sum(self._dead_bytes[segment_id] for segment_id in segment_ids)
+        return float(dead) / total if total else 0.0
+
+
+    def compact(self, min_dead_fraction = 0.0):
+        '''
+        Rewrites the live records of all closed segments into a single segment and deletes the
+        old segments, reclaiming the space used by overwritten values and tombstones. Reads and
+        writes continue while the live records are copied; the lock is only held to swap the
+        key directory over to the new segment.
+
+        :param min_dead_fraction: do nothing unless at least this fraction of closed segment bytes is dead
+        :return: number of bytes reclaimed
+        '''
+        with self._compaction_lock:
+            if self._closed:
+                return 0
+            with self._lock:
+                for fd in self._retired_fds:
+                    os.close(fd)
+                self._retired_fds = []
+                segment_ids = sorted(segment_id for segment_id in self._segment_sizes
+                                     if segment_id != self._active_id)
+                if not segment_ids:
+                    return 0
+                total = sum(self._segment_sizes[segment_id] for segment_id in segment_ids)
+                dead = sum(self._dead_bytes[segment_id] for segment_id in segment_ids)
+                if not dead or float(dead) / total < min_dead_fraction:
+                    return 0
+                # Every older segment is part of the merge, so tombstones can simply be dropped
+                segment_id_set = set(segment_ids)
+                live = sorted((entry, key) for key, entry in self._keydir.iteritems()
+                              if entry[0] in segment_id_set)
+                read_handles = dict((segment_id, self._read_handles[segment_id]) for segment_id in segment_ids)
+
+            first_id, last_id = segment_ids[0], segment_ids[-1]
+            merge_path = self._merge_path(first_id, last_id, 'merge')
+            moved = {}
+            hint_entries = {}
+            offset = 0
+            with open(merge_path, 'wb') as outfile:
+                for (segment_id, record_offset, length), key in live:
+                    outfile.write(self._pread(read_handles[segment_id], length, record_offset))
+                    moved[key] = ((segment_id, record_offset, length), (last_id, offset, length))
+                    hint_entries[key] = (0, offset, length)
+                    offset += length
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            self._write_hint_file(self._merge_path(first_id, last_id, 'merge-hint'), hint_entries)
+            # Renaming to .merged is the commit point. See _recover_merges.
+            os.rename(merge_path, self._merge_path(first_id, last_id, 'merged'))
+            fsync_dir(self.storage_path)
+            merged_fd = os.open(self._merge_path(first_id, last_id, 'merged'), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+            with self._lock:
+                dead_bytes = 0
+                for key, (old_entry, new_entry) in moved.iteritems():
+                    if self._keydir.get(key) == old_entry:
+                        self._keydir[key] = new_entry
+                    else:
+                        # Overwritten or deleted while we were copying
+                        dead_bytes += new_entry[2]
+                for segment_id in segment_ids:
+                    self._retired_fds.append(self._read_handles.pop(segment_id)[0])
+                    del self._segment_sizes[segment_id]
+                    del self._dead_bytes[segment_id]
+                self._read_handles[last_id] = (merged_fd, threading.Lock())
+                self._segment_sizes[last_id] = offset
+                self._dead_bytes[last_id] = dead_bytes
+            self._finish_merge_files(first_id, last_id)
+            return total - offset
+
+
+    def start_compaction(self, interval = 60, min_dead_fraction = 0.5):
+        '''
+        Starts a daemon thread that calls compact every `interval` seconds, until close is called.
+
+        :param interval: seconds between compaction checks
+        :param min_dead_fraction: passed through to compact
+        :return: the compaction thread
+        '''
+        if self._compaction_thread is not None:
+            raise Exception('Compaction is already running')
+        self._compaction_thread = construct_periodic_thread(lambda: self.compact(min_dead_fraction), interval,
+                                                            'PackFileDict compaction', self._compaction_stop)
+        self._compaction_thread.start()
+        return self._compaction_thread
+
+
+    def close(self):
+        '''
+        Stops the compaction thread, if there is one, flushes the active segment and closes all files.
+        The dict may not be used afterwards.
+        '''
+        self._compaction_stop.set()
+        if self._compaction_thread is not None and self._compaction_thread is not threading.current_thread():
+            self._compaction_thread.join()
+        with self._compaction_lock:
+            if self._closed:
+                return
+            self._closed = True
+            with self._lock:
+                os.fsync(self._active_fd)
+                os.close(self._active_fd)
+                for fd, _ in self._read_handles.values():
+                    os.close(fd)
+                for fd in self._retired_fds:
+                    os.close(fd)
+                self._read_handles = {}
+                self._retired_fds = []
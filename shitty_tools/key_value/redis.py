@@ -1,8 +1,100 @@
-from collections import MutableMapping
+import re
+import time
+import threading
+from collections import MutableMapping, OrderedDict
+from ..concurrent import construct_daemon_thread
+from .utility import chunks, update_with_set_many
+
+
+def _escape_glob(pattern):
+    return re.sub(r'([*?\[\]\\])', r'\\\1', pattern)
+
+
+class _NearCache(object):
+    def __init__(self, max_size, ttl):
+        '''
+        Bounded LRU of values read from Redis. While `tracking` is on, entries live until they are
+        invalidated or evicted. Otherwise they expire after `ttl` seconds.
+
+        A read that races with an invalidation must not cache the value it read, so every
+        invalidation bumps a sequence number. Readers note the sequence number before going to
+        Redis and put only succeeds if the key hasn't been invalidated since.
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tracking = False
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._sequence = 0
+        self._sequence_floor = 0
+        self._invalidated_at = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        '''
+        :return: (True, value) on a hit, or (False, sequence number to pass to put) on a miss
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                self._entries[key] = entry
+                self.hits += 1
+                return True, entry[0]
+            self.misses += 1
+            return False, self._sequence
+
+
+    def put(self, key, value, sequence):
+        with self._lock:
+            if sequence < self._sequence_floor or self._invalidated_at.get(key, -1) > sequence:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, None if self.tracking else time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, key):
+        with self._lock:
+            self._sequence += 1
+            self.invalidations += 1
+            self._entries.pop(key, None)
+            self._invalidated_at[key] = self._sequence
+            if len(self._invalidated_at) > self.max_size:
+                # Keep this bounded. Anyone who started reading before now will have to skip caching.
+                self._invalidated_at = {}
+                self._sequence_floor = self._sequence
+
+
+    def set_tracking(self, tracking):
+        with self._lock:
+            self.tracking = tracking
+            self._sequence += 1
+            self._entries.clear()
+            self._invalidated_at = {}
+            self._sequence_floor = self._sequence
+
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                    'invalidations': self.invalidations,
+                    'evictions': self.evictions,
+                    'size': len(self._entries),
+                    'mode': 'tracking' if self.tracking else 'ttl'}
 
 
 class RedisDict(MutableMapping):
-    def __init__(self, redis_conn, key_prefix = '', exp_time = 0, sliding_expiry = False):
+    def __init__(self, redis_conn, key_prefix = '', exp_time = 0, sliding_expiry = False, scan_count = 1000,
+                 key_set_name = None, near_cache_size = 0, near_cache_ttl = 1.0):
         '''
         Provides a dictionary interface to a Redis k-v store.
 
@@ -18,45 +110,305 @@ class RedisDict(MutableMapping):
         :param key_prefix: (transparently) add a prefix to all keys when storing in the backend
         :param exp_time: expiration time to use when setting values
         :param sliding_expiry: extend the expiration time of values when reading them
+        :param scan_count: COUNT hint for the SCAN calls used to iterate keys
+        :param key_set_name: name of a Redis set to maintain with every key in the dict, which makes
+         len() a single SCARD. It must not start with a non-empty key_prefix. Can't be used with exp_time, since
+         expired keys would stay in the set.
+        :param near_cache_size: keep up to this many values in a local LRU cache (0 disables it)
+        :param near_cache_ttl: seconds to keep cached values when keyspace notifications aren't available
         '''
         self.redis = redis_conn
         self.key_prefix = key_prefix
         self.exp_time = exp_time
         self.sliding_expiry = sliding_expiry
+        self.scan_count = scan_count
+        self.key_set_name = key_set_name
+        if key_set_name is not None:
+            if exp_time:
+                raise Exception('A key set cannot be maintained for keys that expire')
+            if key_prefix and key_set_name.startswith(key_prefix):
+                raise Exception('Key set name must not start with the key prefix')
+
+        self._near_cache = None
+        self._near_cache_pubsub = None
+        self._near_cache_closed = False
+        if near_cache_size:
+            if sliding_expiry:
+                raise Exception('Cache hits would not extend the expiry time, so sliding expiry and the near cache '
+                                'cannot be combined')
+            self._near_cache = _NearCache(near_cache_size, near_cache_ttl)
+            if self._keyspace_notifications_enabled():
+                self._near_cache_thread = construct_daemon_thread(self._listen_for_invalidations)
+                self._near_cache_thread.start()
+
+
+    def _keyspace_notifications_enabled(self):
+        try:
+            flags = self.redis.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        except Exception:
+            # CONFIG is often disabled on hosted Redis. Play it safe.
+            return False
+        # Keyspace events for generic commands, strings, expiry and eviction at minimum
+        return 'K' in flags and ('A' in flags or all(flag in flags for flag in 'g$xe'))
+
+
+    def _listen_for_invalidations(self):
+        db = self.redis.connection_pool.connection_kwargs.get('db', 0)
+        channel_prefix = '__keyspace@%s__:%s' % (db, self.key_prefix)
+        pattern = '__keyspace@%s__:%s*' % (db, _escape_glob(self.key_prefix))
+        while not self._near_cache_closed:
+            try:
+                self._near_cache_pubsub = self.redis.pubsub()
+                self._near_cache_pubsub.psubscribe(pattern)
+                for message in self._near_cache_pubsub.listen():
+                    if message['type'] == 'psubscribe':
+                        self._near_cache.set_tracking(True)
+                    elif message['type'] == 'pmessage':
+                        self._near_cache.invalidate(message['channel'][len(channel_prefix):])
+            except Exception:
+                pass
+            # Notifications may have been missed, so fall back to TTLs until we're subscribed again
+            self._near_cache.set_tracking(False)
+            if not self._near_cache_closed:
+                time.sleep(1)
+
+
+    def near_cache_stats(self):
+        '''
+        :return: dict of near cache hits, misses, hit_ratio, invalidations, evictions, size and mode, where
+         mode is 'tracking' while keyspace notifications are keeping the cache coherent and 'ttl' otherwise
+        '''
+        if self._near_cache is None:
+            return None
+        return self._near_cache.stats()
+
+
+    def close(self):
+        '''
+        Stops listening for near cache invalidations.
+        '''
+        self._near_cache_closed = True
+        if self._near_cache_pubsub is not None:
+            try:
+                self._near_cache_pubsub.close()
+            except Exception:
+                pass
 
 
     def __getitem__(self, key):
+        if self._near_cache is None:
+            return self._read(key)
+        hit, value_or_sequence = self._near_cache.get(key)
+        if hit:
+            return value_or_sequence
+        value = self._read(key)
+        self._near_cache.put(key, value, value_or_sequence)
+        return value
+
+
+    def _read(self, key):
         complete_key = self.key_prefix + key
-        value = self.redis.get(complete_key)
+        if self.sliding_expiry and self.exp_time:
+            # Bump the TTL in the same round-trip as the read
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(complete_key)
+            pipe.expire(complete_key, self.exp_time)
+            value = pipe.execute(raise_on_error=False)[0]
+            if isinstance(value, Exception):
+                raise value
+        else:
+            value = self.redis.get(complete_key)
         if value is None:
             raise KeyError
-        try:
-            if self.sliding_expiry and self.exp_time:
-                self.redis.expire(complete_key, self.exp_time)
-        except Exception:
-            pass
         return value
 
 
     def __setitem__(self, key, value):
         complete_key = self.key_prefix + key
-        if self.exp_time:
+        if self.key_set_name is not None:
+            pipe = self.redis.pipeline()
+            pipe.set(complete_key, value)
+            pipe.sadd(self.key_set_name, key)
+            pipe.execute()
+        elif self.exp_time:
             self.redis.setex(complete_key, value, self.exp_time)
         else:
             self.redis.set(complete_key, value)
+        if self._near_cache is not None:
+            # Invalidate after the write so a racing read can't cache the old value
+            self._near_cache.invalidate(key)
 
 
     def __delitem__(self, key):
         complete_key = self.key_prefix + key
-        self.redis.delete(complete_key)
+        if self.key_set_name is not None:
+            pipe = self.redis.pipeline()
+            pipe.delete(complete_key)
+            pipe.srem(self.key_set_name, key)
+            pipe.execute()
+        else:
+            self.redis.delete(complete_key)
+        if self._near_cache is not None:
+            self._near_cache.invalidate(key)
+
+
+    def get_many(self, keys, chunk_size = 1000):
+        '''
+        Fetches many keys with one MGET per chunk. With sliding expiry the TTL bumps are sent in
+        the same pipeline.
+
+        :param keys: iterable of keys
+        :param chunk_size: keys per round-trip
+        :return: dict of the keys that were found and their values
+        '''
+        result = {}
+        sequences = {}
+        if self._near_cache is not None:
+            missed_keys = []
+            for key in keys:
+                hit, value_or_sequence = self._near_cache.get(key)
+                if hit:
+                    result[key] = value_or_sequence
+                else:
+                    missed_keys.append(key)
+                    sequences[key] = value_or_sequence
+            keys = missed_keys
+        for key_chunk in chunks(keys, chunk_size):
+            complete_keys = [self.key_prefix + key for key in key_chunk]
+            if self.sliding_expiry and self.exp_time:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.mget(complete_keys)
+                for complete_key in complete_keys:
+                    pipe.expire(complete_key, self.exp_time)
+                values = pipe.execute(raise_on_error=False)[0]
+                if isinstance(values, Exception):
+                    raise values
+            else:
+                values = self.redis.mget(complete_keys)
+            for key, value in zip(key_chunk, values):
+                if value is not None:
+                    result[key] = value
+                    if key in sequences:
+                        self._near_cache.put(key, value, sequences[key])
+        return result
+
+
+    def set_many(self, items, chunk_size = 1000):
+        '''
+        Writes many key-value pairs with one pipeline per chunk.
+
+        :param items: dict or iterable of (key, value) pairs
+        :param chunk_size: pairs per round-trip
+        '''
+        if hasattr(items, 'items'):
+            items = items.items()
+        for item_chunk in chunks(items, chunk_size):
+            pipe = self.redis.pipeline(transaction=self.key_set_name is not None)
+            for key, value in item_chunk:
+                complete_key = self.key_prefix + key
+                if self.exp_time:
+                    pipe.setex(complete_key, value, self.exp_time)
+                else:
+                    pipe.set(complete_key, value)
+            if self.key_set_name is not None:
+                pipe.sadd(self.key_set_name, *[key for key, _ in item_chunk])
+            pipe.execute()
+            if self._near_cache is not None:
+                for key, _ in item_chunk:
+                    self._near_cache.invalidate(key)
+
+
+    def delete_many(self, keys, chunk_size = 1000):
+        '''
+        Deletes many keys with one DEL per chunk. Missing keys are ignored.
+
+        :param keys: iterable of keys
+        :param chunk_size: keys per round-trip
+        '''
+        for key_chunk in chunks(keys, chunk_size):
+            pipe = self.redis.pipeline(transaction=self.key_set_name is not None)
+            pipe.delete(*[self.key_prefix + key for key in key_chunk])
+            if self.key_set_name is not None:
+                pipe.srem(self.key_set_name, *key_chunk)
+            pipe.execute()
+            if self._near_cache is not None:
+                for key in key_chunk:
+                    self._near_cache.invalidate(key)
+
+
+    update = update_with_set_many
+
+
+    def iteritems(self, chunk_size = 1000):
+        for key_chunk in chunks(self, chunk_size):
+            # Keys deleted since the scan are left out
+            for key, value in self.get_many(key_chunk, chunk_size).iteritems():
+                yield key, value
+
+
+    def itervalues(self, chunk_size = 1000):
+        for _, value in self.iteritems(chunk_size):
+            yield value
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def values(self):
+        return list(self.itervalues())
 
 
     def __iter__(self):
-        for key in self.redis.keys():
-            # TODO: Better way to get keys that start with a prefix?
-            if key.startswith(self.key_prefix):
-                yield key.lstrip(self.key_prefix)
+        # SCAN and SSCAN can return a key more than once, so the keys seen so far are kept to skip
+        # repeats. That's every key in memory by the end of the iteration.
+        seen = set()
+        if self.key_set_name is not None:
+            keys = self.redis.sscan_iter(self.key_set_name, count=self.scan_count)
+        else:
+            keys = self._scan_keys()
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                yield key
+
+
+    def _scan_keys(self):
+        # SCAN rather than KEYS so we don't block the server while it walks the whole keyspace
+        match = _escape_glob(self.key_prefix) + '*' if self.key_prefix else None
+        prefix_length = len(self.key_prefix)
+        for key in self.redis.scan_iter(match=match, count=self.scan_count):
+            yield key[prefix_length:]
 
 
     def __len__(self):
-        return len(self.redis.keys())
\ No newline at end of file
+        if self.key_set_name is not None:
+            return self.redis.scard(self.key_set_name)
+        if not self.key_prefix:
+            return self.redis.dbsize()
+        # Iteration skips keys SCAN returns more than once, which holds every key of the prefix in
+        # memory. Pass key_set_name if that's too much.
+        return sum(1 for _ in self)
+
+
+    def rebuild_key_set(self):
+        '''
+        Rebuilds the key set from a SCAN of the key prefix. Use it when turning on key_set_name for
+        a prefix that already holds data. Writes made while it runs may be missed.
+        '''
+        if self.key_set_name is None:
+            raise Exception('No key set configured')
+        scratch_set_name = self.key_set_name + ':rebuild'
+        self.redis.delete(scratch_set_name)
+        # Without a key prefix the SCAN covers the whole database, sets included
+        own_keys = set([self.key_set_name, scratch_set_name])
+        pipe = self.redis.pipeline(transaction=False)
+        for n, key in enumerate(key for key in self._scan_keys() if key not in own_keys):
+            pipe.sadd(scratch_set_name, key)
+            if n % self.scan_count == self.scan_count - 1:
+                pipe.execute()
+        pipe.execute()
+        if self.redis.exists(scratch_set_name):
+            self.redis.rename(scratch_set_name, self.key_set_name)
+        else:
+            self.redis.delete(self.key_set_name)
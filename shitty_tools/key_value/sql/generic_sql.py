@@ -1,26 +1,82 @@
+import time
 import datetime
-from collections import MutableMapping
-from sqlalchemy import create_engine, insert, select, delete, desc, func, and_, alias
+import threading
+from collections import MutableMapping, OrderedDict
+from sqlalchemy import create_engine, select, update, delete, desc, func, and_, alias, exists, inspect, bindparam
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table, LargeBinary
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.util import LRUCache
+from ...concurrent import construct_periodic_thread
+from ..utility import chunks, update_with_set_many
 
 
 class GenericSqlDict(MutableMapping):
     def __init__(self, connection_string, table_name, key_length = 255, engine_kwargs= {},
-                 snapshot_time = None, prune_on_write = False):
-        write_engine = create_engine(connection_string, **engine_kwargs)
-        self._kv_table = self._generate_kv_table_object(table_name, key_length)
-        if not write_engine.has_table(table_name):
-            self._kv_table.create(bind = write_engine)
-
-        self._get_session = self._construct_session_factory(write_engine)
+                 snapshot_time = None, prune_on_write = False, current_table = False, bulk_chunk_size = 1000,
+                 iter_page_size = 10000, fetch_size = 1000, compiled_cache_size = 500):
+        # Statements are built once with bound parameters and run straight on pooled connections, so
+        # the engine only has to compile each of them once
+        self._engine = self._create_engine(connection_string, engine_kwargs).\
+            execution_options(compiled_cache = LRUCache(compiled_cache_size))
         self._snapshot_time = snapshot_time
         self._prune_on_write = prune_on_write
+        self._bulk_chunk_size = bulk_chunk_size
+        self._iter_page_size = iter_page_size
+        self._fetch_size = fetch_size
+        self._create_tables(self._engine, table_name, key_length, current_table)
+        self._prepare_statements()
+        self._closed = False
+        self._compaction_stop = threading.Event()
+        self._compaction_thread = None
+
 
+    def _create_engine(self, connection_string, engine_kwargs):
+        return create_engine(connection_string, **engine_kwargs)
 
-    def _construct_session_factory(self, engine):
-        session_maker = sessionmaker(engine)
-        return lambda: scoped_session(session_maker)
+
+    def _create_tables(self, engine, table_name, key_length, current_table):
+        self._kv_table = self._generate_kv_table_object(table_name, key_length)
+        if not engine.has_table(table_name):
+            self._kv_table.create(bind = engine)
+
+        # The current table holds the latest version of each key so reads, iteration and len don't
+        # have to dig through history. Snapshot reads still go to the history table.
+        if current_table:
+            current_table_name = '%s_current' % table_name
+            self._current_table = self._generate_current_table_object(current_table_name, key_length)
+            if not engine.has_table(current_table_name):
+                self._current_table.create(bind = engine)
+                self.rebuild_current_table()
+        else:
+            self._current_table = None
+
+
+    def _prepare_statements(self):
+        self._select_key_statement = self._generate_select_key_statement()
+        self._select_many_statement = self._generate_select_many_statement()
+        self._count_statement = self._generate_select_all_keys_statement(count_only = True)
+        self._live_rows_statements = dict(((with_items, paged), self._generate_live_rows_statement(with_items, paged))
+                                          for with_items in (False, True) for paged in (False, True))
+        if self._kv_table is None:
+            return
+        kv = self._kv_table
+        labels = bindparam('labels', expanding = True)
+        self._insert_statement = kv.insert()
+        self._prune_statement = delete(kv).where(kv.c.label == bindparam('prune_label'))
+        self._prune_many_statement = delete(kv).where(kv.c.label.in_(labels))
+        current = self._current_table
+        if current is not None:
+            # Parameters named after columns fill in the SET clause
+            self._update_current_statement = update(current).\
+                where(and_(current.c.label == bindparam('current_label'),
+                           current.c.sequence_number < bindparam('below_sequence_number')))
+            self._select_current_sequence_statement = select([current.c.sequence_number]).\
+                where(current.c.label == bindparam('current_label'))
+            self._insert_current_statement = current.insert()
+            self._delete_current_many_statement = delete(current).where(current.c.label.in_(labels))
+            self._copy_current_many_statement = current.insert().from_select(
+                ['label', 'sequence_number', 'item', 'is_deleted'],
+                self._generate_latest_versions_statement(labels))
 
 
     def _generate_kv_table_object(self, table_name, key_length):
@@ -29,39 +85,337 @@ class GenericSqlDict(MutableMapping):
         t_kv = Table(
             table_name, metadata,
             Column('label', String(key_length), nullable=False),
-            Column('sequence_number', BigInteger, primary_key=True),
+            # SQLite only autoincrements INTEGER primary keys
+            Column('sequence_number', BigInteger().with_variant(Integer, 'sqlite'), primary_key=True),
             Column('item', LargeBinary),
             Column('is_deleted', Integer, nullable=False, default=False),
             Column('created', DateTime, default=datetime.datetime.utcnow),
             Index('label_seq_uq', 'label', 'sequence_number', unique=True),
-            Index('is_deleted_idx', 'is_deleted')
+            Index('is_deleted_idx', 'is_deleted'),
+            # Covers finding the version of a key (or of every key) that was current at a snapshot time
+            Index('%s_label_seq_created_idx' % table_name, 'label', 'sequence_number', 'created', 'is_deleted')
         )
         return t_kv
 
 
-    def _generate_insert_statement(self, key, value, is_deleted):
-        return insert(self._kv_table, values = {'label': key,
-                                                'item': value,
-                                                'is_deleted': is_deleted})
+    def ensure_indexes(self):
+        '''
+        Creates any indexes in the table definitions that are missing from the database. Tables created
+        by older versions of this module won't have the newer indexes until this is run.
+        '''
+        engine = self._engine
+        for table in (self._kv_table, self._current_table):
+            if table is None:
+                continue
+            existing = set(index['name'] for index in inspect(engine).get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind = engine)
+
+
+    def _generate_current_table_object(self, table_name, key_length):
+        metadata = MetaData()
+        t_current = Table(
+            table_name, metadata,
+            Column('label', String(key_length), primary_key=True),
+            Column('sequence_number', BigInteger, nullable=False),
+            Column('item', LargeBinary),
+            Column('is_deleted', Integer, nullable=False, default=False),
+            Index('%s_is_deleted_idx' % table_name, 'is_deleted')
+        )
+        return t_current
+
+
+    def rebuild_current_table(self):
+        '''
+        Repopulates the current table from the history table. This runs automatically when the
+        current table is created. Don't run it while other processes are writing.
+        '''
+        latest = self._generate_latest_versions_statement()
+        with self._engine.begin() as connection:
+            connection.execute(delete(self._current_table))
+            connection.execute(self._current_table.insert().from_select(
+                ['label', 'sequence_number', 'item', 'is_deleted'], latest))
+
+
+    def _write_current(self, connection, key, value, is_deleted, sequence_number):
+        # Only move the current row forward, in case a writer with a lower sequence number commits after us
+        values = {'sequence_number': sequence_number, 'item': value, 'is_deleted': is_deleted}
+        result = connection.execute(self._update_current_statement,
+                                    dict(values, current_label = key, below_sequence_number = sequence_number))
+        if result.rowcount:
+            return
+        if connection.execute(self._select_current_sequence_statement,
+                              current_label = key).scalar() is not None:
+            # A newer write already got there
+            return
+        # If a concurrent writer inserts the row first this raises IntegrityError and _write retries
+        connection.execute(self._insert_current_statement, dict(values, label = key))
 
 
     def _write(self, key, value, is_deleted):
         if self._snapshot_time:
             return
+        for attempt in range(3):
+            try:
+                with self._engine.begin() as connection:
+                    if self._prune_on_write:
+                        connection.execute(self._prune_statement, prune_label = key)
+                    result = connection.execute(self._insert_statement,
+                                                label = key, item = value, is_deleted = is_deleted)
+                    if self._current_table is not None:
+                        self._write_current(connection, key, value, is_deleted, result.inserted_primary_key[0])
+            except IntegrityError:
+                if self._current_table is None or attempt == 2:
+                    raise
+                continue
+            return
+
+
+    def _write_many(self, items, is_deleted):
+        if self._snapshot_time:
+            return
+        # Keep the last write for each key, in order, so the highest sequence number is the last one given
+        latest_items = OrderedDict()
+        for key, value in items:
+            latest_items.pop(key, None)
+            latest_items[key] = value
+        if not latest_items:
+            return
+        for attempt in range(3):
+            try:
+                with self._engine.begin() as connection:
+                    for item_chunk in chunks(latest_items.iteritems(), self._bulk_chunk_size):
+                        self._write_chunk(connection, item_chunk, is_deleted)
+            except IntegrityError:
+                if self._current_table is None or attempt == 2:
+                    raise
+                continue
+            return
+
+
+    def _write_chunk(self, connection, item_chunk, is_deleted):
+        labels = [key for key, _ in item_chunk]
         if self._prune_on_write:
-            delete_statement = delete(self._kv_table).where(key = key)
+            connection.execute(self._prune_many_statement, labels = labels)
+        # executemany
+        connection.execute(self._insert_statement,
+                           [{'label': key, 'item': value, 'is_deleted': is_deleted} for key, value in item_chunk])
+        if self._current_table is not None:
+            # Copy the latest history of these keys over. If a concurrent writer inserts one of
+            # these rows first this raises IntegrityError and _write_many retries.
+            connection.execute(self._delete_current_many_statement, labels = labels)
+            connection.execute(self._copy_current_many_statement, labels = labels)
+
+
+    def set_many(self, items):
+        '''
+        Writes many key-value pairs in a single transaction, inserting bulk_chunk_size rows per
+        executemany.
+
+        :param items: dict or iterable of (key, value) pairs
+        '''
+        if hasattr(items, 'items'):
+            items = items.items()
+        self._write_many(items, False)
+
+
+    def delete_many(self, keys):
+        '''
+        Deletes many keys in a single transaction. Missing keys are ignored.
+
+        :param keys: iterable of keys
+        '''
+        self._write_many(((key, None) for key in keys), True)
+
+
+    def get_many(self, keys):
+        '''
+        Reads the latest version of many keys with one query per bulk_chunk_size keys.
+
+        :param keys: iterable of keys
+        :return: dict of the keys that were found and their values
+        '''
+        result = {}
+        with self._engine.connect() as connection:
+            for key_chunk in chunks(keys, self._bulk_chunk_size):
+                for row in connection.execute(self._select_many_statement, labels = list(key_chunk)):
+                    if not row.is_deleted:
+                        result[row.label] = row.item
+        return result
+
+
+    update = update_with_set_many
+
+
+    def iteritems(self):
+        for row in self._iter_live_rows(with_items = True):
+            yield row.label, row.item
+
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def compact(self, keep_versions = 1, keep_newer_than = None, drop_tombstones = True, batch_size = 1000,
+                batch_pause = 0):
+        '''
+        Deletes history that is no longer needed, batch_size rows per transaction, so table growth can
+        be bounded without paying for it on every write like prune_on_write does.
+
+        A version is deleted once keep_versions newer versions of its key exist. If keep_newer_than is
+        given, versions written within that window are kept along with the version that was current at
+        the start of it, so snapshot_time reads inside the window still see what they should.
+
+        With drop_tombstones, keys whose latest version is a delete that is older than the window have
+        their history removed entirely.
+
+        :param keep_versions: number of versions of each key to keep
+        :param keep_newer_than: timedelta (or seconds) of history to keep whole
+        :param drop_tombstones: also purge keys that were deleted before the window
+        :param batch_size: rows deleted per transaction
+        :param batch_pause: seconds to sleep between batches to go easy on the database
+        :return: number of history rows deleted
+        '''
+        if self._closed:
+            return 0
+        if keep_newer_than is not None and not isinstance(keep_newer_than, datetime.timedelta):
+            keep_newer_than = datetime.timedelta(seconds=keep_newer_than)
+        cutoff = datetime.datetime.utcnow() - keep_newer_than if keep_newer_than is not None else None
+        kv = self._kv_table
+        newer = alias(self._kv_table, 'newer')
+
+        newer_condition = and_(newer.c.label == kv.c.label, newer.c.sequence_number > kv.c.sequence_number)
+        if keep_versions == 1:
+            superseded = exists(select([newer.c.sequence_number]).where(newer_condition))
         else:
-            delete_statement = None
-        insert_statement = self._generate_insert_statement(key, value, is_deleted)
-        with self._get_session().no_autoflush as session:
-            if delete_statement:
-                session.execute(delete_statement)
-            session.execute(insert_statement)
-            session.commit()
-        session.close()
+            superseded = select([func.count(newer.c.sequence_number)]).where(newer_condition).as_scalar() >= \
+                         keep_versions
+        if cutoff is not None:
+            # Something newer must also have been current at the cutoff, otherwise this version is what a
+            # snapshot at the cutoff would read
+            superseded = and_(superseded, kv.c.created < cutoff,
+                              exists(select([newer.c.sequence_number]).where(and_(newer_condition,
+                                                                                  newer.c.created <= cutoff))))
+        deleted = self._delete_in_batches(select([kv.c.sequence_number]).where(superseded),
+                                          batch_size, batch_pause)
+
+        if drop_tombstones:
+            tombstone_condition = and_(kv.c.is_deleted != 0,
+                                       ~exists(select([newer.c.sequence_number]).where(newer_condition)))
+            if cutoff is not None:
+                tombstone_condition = and_(tombstone_condition, kv.c.created < cutoff)
+            tombstones = select([kv.c.label, kv.c.sequence_number]).where(tombstone_condition)
+            for batch in self._iter_batches(tombstones, batch_size, batch_pause):
+                deleted += self._purge_tombstones(dict((row.label, row.sequence_number) for row in batch),
+                                                  batch_size)
+        return deleted
+
+
+    def _purge_tombstones(self, purge_up_to, batch_size):
+        # Everything up to and including each tombstone. Writes since then are left alone. The rows
+        # are picked out here and deleted by primary key, since one condition per label makes an
+        # expression too deep for some databases (SQLite stops at a depth of 1000).
+        kv = self._kv_table
+        labels = list(purge_up_to)
+        with self._engine.begin() as connection:
+            history = [row.sequence_number for row in
+                       connection.execute(select([kv.c.label, kv.c.sequence_number]).where(kv.c.label.in_(labels)))
+                       if row.sequence_number <= purge_up_to[row.label]]
+            for sequence_chunk in chunks(history, batch_size):
+                connection.execute(delete(kv).where(kv.c.sequence_number.in_(sequence_chunk)))
+            if self._current_table is not None:
+                # A key written again since its tombstone isn't deleted in the current table any more
+                current = self._current_table
+                connection.execute(delete(current).where(and_(current.c.label.in_(labels),
+                                                              current.c.is_deleted != 0)))
+        return len(history)
+
+
+    def _iter_batches(self, sequence_number_select, batch_size, batch_pause):
+        '''
+        Pages through a select of rows with a sequence_number column, batch_size rows at a time, by
+        carrying on from the last sequence number seen. Each page is an index range scan, so rows that
+        are kept aren't read again by every later batch. Yields each page as a list of rows and sleeps
+        batch_pause seconds between pages.
+        '''
+        sequence_number = self._kv_table.c.sequence_number
+        last_seen = None
+        while True:
+            page_select = sequence_number_select.order_by(sequence_number).limit(batch_size)
+            if last_seen is not None:
+                page_select = page_select.where(sequence_number > last_seen)
+            with self._engine.connect() as connection:
+                batch = connection.execute(page_select).fetchall()
+            if batch:
+                last_seen = batch[-1].sequence_number
+                yield batch
+            # close() waits for a running compaction, so don't keep it waiting for the whole table
+            if len(batch) < batch_size or self._closed:
+                return
+            time.sleep(batch_pause)
+
+
+    def _delete_in_batches(self, sequence_number_select, batch_size, batch_pause):
+        deleted = 0
+        sequence_number = self._kv_table.c.sequence_number
+        for batch in self._iter_batches(sequence_number_select, batch_size, batch_pause):
+            with self._engine.begin() as connection:
+                connection.execute(delete(self._kv_table).
+                                   where(sequence_number.in_([row.sequence_number for row in batch])))
+            deleted += len(batch)
+        return deleted
+
 
+    def start_compaction(self, interval = 3600, **compact_kwargs):
+        '''
+        Starts a daemon thread that calls compact every `interval` seconds, until close is called.
 
-    def _generate_select_key_statement(self, key):
+        :param interval: seconds between compactions
+        :param compact_kwargs: passed through to compact
+        :return: the compaction thread
+        '''
+        if self._compaction_thread is not None:
+            raise Exception('Compaction is already running')
+        self._compaction_thread = construct_periodic_thread(lambda: self.compact(**compact_kwargs), interval,
+                                                            'GenericSqlDict compaction', self._compaction_stop)
+        self._compaction_thread.start()
+        return self._compaction_thread
+
+
+    def close(self):
+        '''
+        Stops the compaction thread, if there is one, and closes the engine's pooled connections.
+        The dict may not be used afterwards.
+        '''
+        self._closed = True
+        self._compaction_stop.set()
+        if self._compaction_thread is not None and self._compaction_thread is not threading.current_thread():
+            self._compaction_thread.join()
+        self._engine.dispose()
+
+
+    def _current_is_deleted(self):
+        '''
+        :return: the expression current table reads use for the is_deleted flag
+        '''
+        return self._current_table.c.is_deleted
+
+
+    def _generate_select_key_statement(self):
+        key = bindparam('key')
+        if self._current_table is not None and not self._snapshot_time:
+            return select([self._current_table.c.item, self._current_is_deleted().label('is_deleted')]).\
+                where(self._current_table.c.label == key)
         sel_stmt = select([self._kv_table.c.item, self._kv_table.c.is_deleted]).where(self._kv_table.c.label == key).\
             order_by(desc(self._kv_table.c.sequence_number)).limit(1)
         if self._snapshot_time:
@@ -69,35 +423,96 @@ class GenericSqlDict(MutableMapping):
         return sel_stmt
 
 
-    def _generate_select_all_keys_statement(self, count_only = False):
-        # TODO: This query could probably be more efficient
+    def _generate_select_many_statement(self):
+        labels = bindparam('labels', expanding = True)
+        if self._current_table is not None and not self._snapshot_time:
+            current = self._current_table
+            return select([current.c.label, current.c.item, self._current_is_deleted().label('is_deleted')]).\
+                where(current.c.label.in_(labels))
+        return self._generate_latest_versions_statement(labels, self._snapshot_time)
+
+
+    def _generate_latest_versions_join(self, snapshot_time = None):
+        '''
+        :return: (lhs, from clause, where clause) selecting the latest version of each label in the history table
+        '''
         lhs = alias(self._kv_table, 'lhs')
         rhs = alias(self._kv_table, 'rhs')
-        if count_only:
-            fields = [func.count(lhs.c.label)]
-        else:
-            fields = [lhs.c.label]
-        select_statement = select(fields).\
-            select_from(lhs.
-                        outerjoin(rhs,
-                                  and_(rhs.c.label == lhs.c.label,
-                                       rhs.c.sequence_number > lhs.c.sequence_number))).\
-            where(and_(rhs.c.label.is_(None),
-                       lhs.c.is_deleted == 0))
-        if self._snapshot_time:
-            select_statement= select_statement.where(lhs.c.created <= self._snapshot_time)
+        join_condition = and_(rhs.c.label == lhs.c.label,
+                              rhs.c.sequence_number > lhs.c.sequence_number)
+        where_clause = rhs.c.label.is_(None)
+        if snapshot_time:
+            # Versions written after the snapshot don't supersede anything
+            join_condition = and_(join_condition, rhs.c.created <= snapshot_time)
+            where_clause = and_(where_clause, lhs.c.created <= snapshot_time)
+        return lhs, lhs.outerjoin(rhs, join_condition), where_clause
+
+
+    def _generate_latest_versions_statement(self, labels = None, snapshot_time = None):
+        lhs, from_clause, where_clause = self._generate_latest_versions_join(snapshot_time)
+        select_statement = select([lhs.c.label, lhs.c.sequence_number, lhs.c.item, lhs.c.is_deleted]).\
+            select_from(from_clause).where(where_clause)
+        if labels is not None:
+            select_statement = select_statement.where(lhs.c.label.in_(labels))
         return select_statement
 
 
+    def _generate_select_all_keys_statement(self, count_only = False):
+        if self._current_table is not None and not self._snapshot_time:
+            current = self._current_table
+            fields = [func.count(current.c.label)] if count_only else [current.c.label]
+            return select(fields).where(self._current_is_deleted() == 0)
+        lhs, from_clause, where_clause = self._generate_latest_versions_join(self._snapshot_time)
+        fields = [func.count(lhs.c.label)] if count_only else [lhs.c.label]
+        return select(fields).select_from(from_clause).where(and_(where_clause, lhs.c.is_deleted == 0))
+
+
+    def _generate_live_rows_statement(self, with_items, paged):
+        if self._current_table is not None and not self._snapshot_time:
+            current = self._current_table
+            label_column = current.c.label
+            fields = [current.c.label, current.c.item] if with_items else [current.c.label]
+            select_statement = select(fields).where(self._current_is_deleted() == 0)
+        else:
+            lhs, from_clause, where_clause = self._generate_latest_versions_join(self._snapshot_time)
+            label_column = lhs.c.label
+            fields = [lhs.c.label, lhs.c.item] if with_items else [lhs.c.label]
+            select_statement = select(fields).select_from(from_clause).\
+                where(and_(where_clause, lhs.c.is_deleted == 0))
+        if paged:
+            select_statement = select_statement.where(label_column > bindparam('after_label'))
+        return select_statement.order_by(label_column).limit(self._iter_page_size).\
+            execution_options(stream_results = True)
+
+
+    def _iter_live_rows(self, with_items = False):
+        # Keyset pagination: each page picks up after the last label of the one before, so no
+        # single query has to walk or hold the whole table, and rows are streamed within a page.
+        after_label = None
+        while True:
+            select_statement = self._live_rows_statements[(with_items, after_label is not None)]
+            row_count = 0
+            with self._engine.connect() as connection:
+                result = connection.execute(select_statement, after_label = after_label)
+                while True:
+                    rows = result.fetchmany(self._fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        row_count += 1
+                        after_label = row.label
+                        yield row
+            if row_count < self._iter_page_size:
+                return
+
+
     def _read(self, key):
-        select_statement = self._generate_select_key_statement(key)
-        with self._get_session().no_autoflush as session:
-            result = session.execute(select_statement).fetchone()
-            if result is None:
-                raise KeyError
-            if result.is_deleted:
-                raise KeyError
-        session.close()
+        with self._engine.connect() as connection:
+            result = connection.execute(self._select_key_statement, key = key).fetchone()
+        if result is None:
+            raise KeyError
+        if result.is_deleted:
+            raise KeyError
         return result.item
 
 
@@ -114,16 +529,10 @@ class GenericSqlDict(MutableMapping):
 
 
     def __iter__(self):
-        select_statement = self._generate_select_all_keys_statement()
-        with self._get_session().no_autoflush as session:
-            for row in session.execute(select_statement):
-                yield row.label
-        session.close()
+        for row in self._iter_live_rows():
+            yield row.label
 
 
     def __len__(self):
-        select_statement = self._generate_select_all_keys_statement(count_only=True)
-        with self._get_session().no_autoflush as session:
-            result = session.execute(select_statement).scalar()
-        session.close()
-        return result
\ No newline at end of file
+        with self._engine.connect() as connection:
+            return connection.execute(self._count_statement).scalar()
\ No newline at end of file
@@ -14,6 +14,20 @@ class MySqlDict(GenericSqlDict):
             Column('is_deleted', TINYINT(1), nullable=False, server_default=text("'0'")),
             Column('created', TIMESTAMP, server_default=text("CURRENT_TIMESTAMP")),
             Index('key_seq_uq', 'label', 'sequence_number', unique=True),
-            Index('is_deleted_idx', 'is_deleted')
+            Index('is_deleted_idx', 'is_deleted'),
+            Index('%s_label_seq_created_idx' % table_name, 'label', 'sequence_number', 'created', 'is_deleted')
         )
-        return t_kv
\ No newline at end of file
+        return t_kv
+
+
+    def _generate_current_table_object(self, table_name, key_length):
+        metadata = MetaData()
+        t_current = Table(
+            table_name, metadata,
+            Column('label', VARCHAR(key_length), primary_key=True),
+            Column('sequence_number', BIGINT(30), nullable=False),
+            Column('item', LONGBLOB),
+            Column('is_deleted', TINYINT(1), nullable=False, server_default=text("'0'")),
+            Index('%s_is_deleted_idx' % table_name, 'is_deleted')
+        )
+        return t_current
\ No newline at end of file
@@ -0,0 +1,152 @@
+from sqlalchemy import Column, LargeBinary, MetaData, String, Table
+from sqlalchemy import create_engine, event, delete, bindparam, text, literal_column
+from sqlalchemy.pool import QueuePool
+from generic_sql import GenericSqlDict
+
+
+class SqliteDict(GenericSqlDict):
+    def __init__(self, connection_string, table_name, keep_history = False, journal_mode = 'WAL',
+                 synchronous = 'NORMAL', mmap_size = 256 * 1024 * 1024, cache_size = -64 * 1024, **kwargs):
+        '''
+        SqlDict tuned for SQLite. Connections are pooled and reused rather than opened for every
+        operation, and every connection is set up with the given pragmas.
+
+        By default no history is kept. The table holds one row per key and writes are
+        INSERT ... ON CONFLICT upserts. Pass keep_history = True to get the GenericSqlDict behaviour
+        (history, snapshot_time, current_table, compaction) on SQLite.
+
+        >>> d = SqliteDict('sqlite:////var/cache/myapp/kv.db', 'kv')
+
+        :param connection_string: sqlalchemy connection string, e.g. sqlite:////path/to/db
+        :param table_name: table to store keys and values in
+        :param keep_history: keep every version of every key like GenericSqlDict
+        :param journal_mode: PRAGMA journal_mode
+        :param synchronous: PRAGMA synchronous. NORMAL is safe with WAL and only risks the last
+         transactions on power loss.
+        :param mmap_size: PRAGMA mmap_size in bytes
+        :param cache_size: PRAGMA cache_size. Negative values are KiB, positive values pages.
+        :param kwargs: passed through to GenericSqlDict
+        '''
+        self._keep_history = keep_history
+        self._pragmas = [('journal_mode', journal_mode),
+                         ('synchronous', synchronous),
+                         ('mmap_size', mmap_size),
+                         ('cache_size', cache_size)]
+        if not keep_history:
+            for history_option in ('snapshot_time', 'prune_on_write', 'current_table'):
+                if kwargs.get(history_option):
+                    raise Exception('%s requires keep_history = True' % history_option)
+        super(SqliteDict, self).__init__(connection_string, table_name, **kwargs)
+
+
+    def _create_engine(self, connection_string, engine_kwargs):
+        engine_kwargs = dict(engine_kwargs)
+        if connection_string in ('sqlite://', 'sqlite:///:memory:'):
+            # Every connection to :memory: is a different database, so all threads have to share one.
+            # A pool of exactly one also makes threads take turns with it instead of interleaving transactions.
+            engine_kwargs.setdefault('poolclass', QueuePool)
+            engine_kwargs.setdefault('pool_size', 1)
+            engine_kwargs.setdefault('max_overflow', 0)
+            engine_kwargs.setdefault('connect_args', {'check_same_thread': False})
+        else:
+            # A file can be opened by any number of connections. Pool them rather than keeping one per
+            # thread, which sqlalchemy closes out from under its owner once there are more threads than
+            # it keeps. Pooled connections move between threads, but only one thread uses one at a time.
+            engine_kwargs.setdefault('poolclass', QueuePool)
+            engine_kwargs.setdefault('pool_size', 16)
+            engine_kwargs.setdefault('connect_args', {'check_same_thread': False})
+        engine = create_engine(connection_string, **engine_kwargs)
+        pragmas = self._pragmas
+
+        # A plain function, since sqlalchemy's event registry hashes listeners and MutableMappings aren't hashable
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas:
+                if value is not None:
+                    cursor.execute('PRAGMA %s = %s' % (pragma, value))
+            cursor.close()
+        event.listen(engine, 'connect', set_pragmas)
+        return engine
+
+
+    def _create_tables(self, engine, table_name, key_length, current_table):
+        if self._keep_history:
+            return super(SqliteDict, self)._create_tables(engine, table_name, key_length, current_table)
+        # Without history the store table is the only table. It looks enough like a current table
+        # for GenericSqlDict's current table reads, iteration and len to work on it unchanged.
+        # Deletes remove the row, so it has no is_deleted column (see _current_is_deleted).
+        self._kv_table = None
+        self._current_table = self._generate_store_table_object(table_name, key_length)
+        if not engine.has_table(table_name):
+            self._current_table.create(bind = engine)
+        self._upsert_statement = text(
+            'INSERT INTO "%s" (label, item) VALUES (:label, :item) '
+            'ON CONFLICT (label) DO UPDATE SET item = excluded.item' % table_name).\
+            bindparams(bindparam('item', type_ = LargeBinary))
+        self._delete_statement = delete(self._current_table).\
+            where(self._current_table.c.label == bindparam('delete_label'))
+
+
+    def _generate_store_table_object(self, table_name, key_length):
+        metadata = MetaData()
+        t_store = Table(
+            table_name, metadata,
+            Column('label', String(key_length), primary_key=True),
+            Column('item', LargeBinary)
+        )
+        return t_store
+
+
+    def _current_is_deleted(self):
+        if self._keep_history:
+            return super(SqliteDict, self)._current_is_deleted()
+        # Every row in the store table is live
+        return literal_column('0')
+
+
+    def _write(self, key, value, is_deleted):
+        if self._keep_history:
+            return super(SqliteDict, self)._write(key, value, is_deleted)
+        with self._engine.begin() as connection:
+            if is_deleted:
+                connection.execute(self._delete_statement, delete_label = key)
+            else:
+                connection.execute(self._upsert_statement, label = key, item = value)
+
+
+    def _write_chunk(self, connection, item_chunk, is_deleted):
+        if self._keep_history:
+            return super(SqliteDict, self)._write_chunk(connection, item_chunk, is_deleted)
+        if is_deleted:
+            connection.execute(self._delete_statement, [{'delete_label': key} for key, _ in item_chunk])
+        else:
+            connection.execute(self._upsert_statement, [{'label': key, 'item': value} for key, value in item_chunk])
+
+
+    def _iter_live_rows(self, with_items = False):
+        # Each thread only has the one connection, and anything else this thread does to the dict
+        # mid-iteration would end the transaction a streaming cursor is reading from. So fetch a
+        # page, let the connection go, then hand the page out.
+        after_label = None
+        while True:
+            select_statement = self._live_rows_statements[(with_items, after_label is not None)]
+            with self._engine.connect() as connection:
+                rows = connection.execute(select_statement, after_label = after_label).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < self._iter_page_size:
+                return
+            after_label = rows[-1].label
+
+
+    def rebuild_current_table(self):
+        if not self._keep_history:
+            raise Exception('There is no history to rebuild from when keep_history is off')
+        return super(SqliteDict, self).rebuild_current_table()
+
+
+    def compact(self, *args, **kwargs):
+        if not self._keep_history:
+            # Nothing to compact
+            return 0
+        return super(SqliteDict, self).compact(*args, **kwargs)
@@ -1,9 +1,41 @@
+import time
 from collections import MutableMapping, defaultdict
 from thread import get_ident
-from threading import Thread
+from threading import Thread, Lock, Event, current_thread
 from random import choice
 from Queue import Queue
 from zlib import adler32
+from ..concurrent import construct_periodic_thread
+
+
+def chunks(iterable, chunk_size):
+    '''
+    Splits an iterable into lists of up to chunk_size items. Handy for bulk operations.
+    :param iterable: anything iterable
+    :param chunk_size: maximum number of items per list
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def update_with_set_many(*args, **kwargs):
+    '''
+    MutableMapping.update for dicts with a set_many, so an update is one bulk write rather than a
+    __setitem__ per pair. Use it as `update = update_with_set_many` in the class body.
+    '''
+    # Same signature dance as MutableMapping.update so 'self' can be passed as a keyword
+    self = args[0]
+    items = []
+    for other in args[1:]:
+        items.extend(other.items() if hasattr(other, 'items') else other)
+    items.extend(kwargs.items())
+    self.set_many(items)
 
 
 class ReadOnlyDict(MutableMapping):
@@ -211,4 +243,265 @@ class ThreadedSerialAccessDict(MutableMapping):
         thread_id = get_ident()
         response_queue = self.response_queue_dict[thread_id]
         self.operation_queue.put({'op': 'len', 'thread_id': thread_id})
-        return response_queue.get()
\ No newline at end of file
+        return response_queue.get()
+
+
+# Histogram buckets are powers of two. Bucket n counts values from 2**(n-1) up to 2**n - 1, so
+# bucket 0 is just 0. Latencies are counted in microseconds and value sizes in bytes.
+_HISTOGRAM_BUCKETS = 48
+
+
+def _histogram_dict(buckets):
+    return dict((str(2 ** n - 1), count) for n, count in enumerate(buckets) if count)
+
+
+def _histogram_percentile(buckets, total, fraction):
+    # Upper bound of the bucket the percentile falls in
+    if not total:
+        return None
+    target = total * fraction
+    seen = 0
+    for n, count in enumerate(buckets):
+        seen += count
+        if seen >= target:
+            return 2 ** n - 1
+    return 2 ** (len(buckets) - 1) - 1
+
+
+class _OperationStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.misses = 0
+        self.seconds = 0.0
+        self.latency_buckets = [0] * _HISTOGRAM_BUCKETS
+        self.size_buckets = [0] * _HISTOGRAM_BUCKETS
+
+    def snapshot(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'misses': self.misses,
+                'miss_rate': float(self.misses) / self.count if self.count else 0.0,
+                'mean_us': self.seconds * 1e6 / self.count if self.count else None,
+                'p50_us': _histogram_percentile(self.latency_buckets, self.count, 0.5),
+                'p99_us': _histogram_percentile(self.latency_buckets, self.count, 0.99),
+                'p999_us': _histogram_percentile(self.latency_buckets, self.count, 0.999),
+                'latency_us_histogram': _histogram_dict(self.latency_buckets),
+                'value_size_histogram': _histogram_dict(self.size_buckets)}
+
+
+class _HeavyHitters(object):
+    def __init__(self, capacity):
+        '''
+        Misra-Gries summary of the most frequent keys in capacity counters. Any key seen more than
+        1/capacity of the time is guaranteed to be in it, and its count is an underestimate by at
+        most total/capacity. A new key when every counter is taken decrements them all instead,
+        which is O(capacity), but there can only be one of those per capacity increments so it
+        works out to constant time per key.
+        '''
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+
+    def add(self, key):
+        self.total += 1
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+        elif len(counts) < self.capacity:
+            counts[key] = 1
+        else:
+            for counted_key in list(counts):
+                if counts[counted_key] == 1:
+                    del counts[counted_key]
+                else:
+                    counts[counted_key] -= 1
+
+    def top(self, n):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+class InstrumentedDict(MutableMapping):
+    def __init__(self, wrapped_dict, hot_key_capacity = 100, snapshot_callback = None, snapshot_interval = 60):
+        '''
+        Wraps any dict and records what goes through it: counts, errors, misses (KeyErrors) and a
+        latency histogram per operation, value size histograms for gets and sets, and the hottest keys.
+        It can wrap any layer of a stack of dicts, or several layers to see where time goes.
+
+        Recording costs a couple of microseconds per operation. Histograms are fixed power of two
+        buckets and hot keys are a fixed number of counters, so memory stays bounded however long it runs.
+
+        Anything else is passed straight through to the wrapped dict. get_many, set_many and
+        delete_many are recorded too, with the number of keys as the value size and missing keys as
+        misses, and so are the streaming open_value and set_stream, along with their keys. For
+        open_value only opening the value is timed, not reading it.
+
+        Read the numbers with snapshot(), pass a snapshot_callback to be handed one every
+        snapshot_interval seconds, or serve it with flask_kv, which has a /_bulk/stats endpoint
+        for stores with a snapshot method.
+
+        >>> redis_dict = InstrumentedDict(RedisDict(redis_conn), snapshot_callback = log_stats)
+        >>> redis_dict.snapshot()['operations']['get']['p99_us']
+
+        :param wrapped_dict: dict to instrument
+        :param hot_key_capacity: number of counters for tracking the hottest keys
+        :param snapshot_callback: function to call with a snapshot every snapshot_interval seconds, until
+         close() is called. If it raises, the exception is logged and it's called again next time.
+        :param snapshot_interval: seconds between calls to snapshot_callback
+        '''
+        self.wrapped_dict = wrapped_dict
+        self.hot_key_capacity = hot_key_capacity
+        self._lock = Lock()
+        self.reset()
+        self._snapshot_stop = Event()
+        self.snapshot_thread = None
+        if snapshot_callback is not None:
+            self.snapshot_thread = construct_periodic_thread(lambda: snapshot_callback(self.snapshot()),
+                                                             snapshot_interval, 'InstrumentedDict snapshot_callback',
+                                                             self._snapshot_stop)
+            self.snapshot_thread.start()
+
+    def close(self):
+        '''
+        Stops handing snapshots to snapshot_callback. The wrapped dict isn't closed, and the dict
+        carries on recording.
+        '''
+        self._snapshot_stop.set()
+        if self.snapshot_thread is not None and self.snapshot_thread is not current_thread():
+            self.snapshot_thread.join()
+
+    def reset(self):
+        with self._lock:
+            self._operations = defaultdict(_OperationStats)
+            self._hot_keys = _HeavyHitters(self.hot_key_capacity)
+            self._started = time.time()
+
+    def snapshot(self, hot_keys = 20):
+        '''
+        :param hot_keys: how many of the hottest keys to include
+        :return: JSON serializable dict of everything recorded since the dict was created or reset
+        '''
+        with self._lock:
+            now = time.time()
+            return {'since': self._started,
+                    'seconds': now - self._started,
+                    'operations': dict((name, stats.snapshot()) for name, stats in self._operations.items()),
+                    'hot_keys': [{'key': key, 'count': count} for key, count in self._hot_keys.top(hot_keys)],
+                    'key_accesses': self._hot_keys.total}
+
+    def _record(self, operation, start, key = None, size = None, misses = 0, error = False):
+        elapsed = time.time() - start
+        latency_bucket = int(elapsed * 1000000).bit_length()
+        with self._lock:
+            stats = self._operations[operation]
+            stats.count += 1
+            stats.seconds += elapsed
+            stats.latency_buckets[latency_bucket if latency_bucket < _HISTOGRAM_BUCKETS else -1] += 1
+            if misses:
+                stats.misses += misses
+            if error:
+                stats.errors += 1
+            if size is not None:
+                size_bucket = size.bit_length()
+                stats.size_buckets[size_bucket if size_bucket < _HISTOGRAM_BUCKETS else -1] += 1
+            if key is not None:
+                self._hot_keys.add(key)
+
+    def _record_failure(self, operation, start, key, exception):
+        # KeyError is a miss rather than an error. Either way the caller re-raises it.
+        if isinstance(exception, KeyError):
+            self._record(operation, start, key, misses=1)
+        else:
+            self._record(operation, start, key, error=True)
+
+    # Each operation is written out rather than going through a shared wrapper, since the extra
+    # function call would be a good part of the overhead
+
+    def __getitem__(self, key):
+        start = time.time()
+        try:
+            value = self.wrapped_dict[key]
+        except Exception as e:
+            self._record_failure('get', start, key, e)
+            raise
+        self._record('get', start, key, len(value) if hasattr(value, '__len__') else None)
+        return value
+
+    def __setitem__(self, key, value):
+        start = time.time()
+        try:
+            self.wrapped_dict[key] = value
+        except Exception as e:
+            self._record_failure('set', start, key, e)
+            raise
+        self._record('set', start, key, len(value) if hasattr(value, '__len__') else None)
+
+    def __delitem__(self, key):
+        start = time.time()
+        try:
+            del(self.wrapped_dict[key])
+        except Exception as e:
+            self._record_failure('delete', start, key, e)
+            raise
+        self._record('delete', start, key)
+
+    def __iter__(self):
+        # Only the call is timed, not the iteration, which is up to the caller
+        start = time.time()
+        try:
+            keys = iter(self.wrapped_dict)
+        except Exception as e:
+            self._record_failure('iter', start, None, e)
+            raise
+        self._record('iter', start)
+        return keys
+
+    def __len__(self):
+        start = time.time()
+        try:
+            length = len(self.wrapped_dict)
+        except Exception as e:
+            self._record_failure('len', start, None, e)
+            raise
+        self._record('len', start)
+        return length
+
+    def _bulk(self, operation, f):
+        # Records get_many, set_many or delete_many with the number of keys as the value size
+        def instrumented(keys_or_items):
+            keys_or_items = list(keys_or_items.items() if hasattr(keys_or_items, 'items') else keys_or_items)
+            start = time.time()
+            try:
+                result = f(keys_or_items)
+            except Exception as e:
+                self._record_failure(operation, start, None, e)
+                raise
+            misses = len(keys_or_items) - len(result) if operation == 'get_many' else 0
+            self._record(operation, start, size=len(keys_or_items), misses=misses)
+            return result
+        return instrumented
+
+    def _stream(self, operation, f):
+        # Records open_value or set_stream against the key, without a value size
+        def instrumented(key, *args, **kwargs):
+            start = time.time()
+            try:
+                result = f(key, *args, **kwargs)
+            except Exception as e:
+                self._record_failure(operation, start, key, e)
+                raise
+            self._record(operation, start, key)
+            return result
+        return instrumented
+
+    def __getattr__(self, name):
+        # Only called for attributes InstrumentedDict doesn't have, so bulk and streaming methods of the
+        # wrapped dict are still there for code that checks with hasattr
+        if name == 'wrapped_dict':
+            raise AttributeError(name)
+        attribute = getattr(self.wrapped_dict, name)
+        if name in ('get_many', 'set_many', 'delete_many'):
+            return self._bulk(name, attribute)
+        if name in ('open_value', 'set_stream'):
+            return self._stream(name, attribute)
+        return attribute
@@ -1,14 +1,172 @@
-from sqlalchemy.exc import IntegrityError
+import time
+import random
+from threading import Lock
+from collections import OrderedDict
+from sqlalchemy import and_, or_, event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import class_mapper, make_transient_to_detached, Session, scoped_session
+from ..key_value.utility import chunks
+from .statements import insert_ignore_statement
 
 
-# TODO: Add retries with exponential back-off on OperationalError
 # On MariaDB/Percona platform with galera replication, writes to a single table with a unique constraint
 # on multiple nodes can result in deadlocks & timeouts when unique values written on multiple nodes
 # collide. The solution is to exponential back-off with a random jitter to allow one of the writes to
-# succeed.
+# succeed. Everything here retries on OperationalError like that, rolling back the session first since
+# the database has already aborted the transaction.
 
 
-def get_or_create(object_class, object_dict, db_session):
+# Where a session keeps the cache entries it has made, keyed on the top level transaction they were
+# made in
+_PENDING_INFO_KEY = 'shitty_tools_get_or_create_pending'
+_listener_lock = Lock()
+_listening = []
+
+
+def _root_transaction(transaction):
+    while transaction.parent is not None:
+        transaction = transaction.parent
+    return transaction
+
+
+def _publish_pending(session):
+    # Also fires when a savepoint is released, which doesn't make anything visible to other sessions
+    transaction = session.transaction
+    if transaction is None or transaction.parent is not None:
+        return
+    for cache, key, primary_key in session.info.get(_PENDING_INFO_KEY, {}).pop(transaction, ()):
+        cache.put(key, primary_key)
+
+
+def _discard_pending(session, transaction):
+    # Every way out of a transaction ends up here, commit, rollback and close alike. After a commit
+    # the entries have already been published.
+    if transaction.parent is None:
+        session.info.get(_PENDING_INFO_KEY, {}).pop(transaction, None)
+
+
+def _listen_for_transaction_ends():
+    # Registered once on Session itself, which covers every session, including scoped ones
+    with _listener_lock:
+        if not _listening:
+            event.listen(Session, 'after_commit', _publish_pending)
+            event.listen(Session, 'after_transaction_end', _discard_pending)
+            _listening.append(True)
+
+
+class IdentityCache(object):
+    def __init__(self, max_size = 10000):
+        '''
+        Bounded LRU cache from (object class, object dict) to primary key for get_or_create and
+        get_or_create_list, so hot rows can be handed back without touching the database.
+
+        One cache can be shared by any number of sessions and threads. Entries made during a
+        transaction are only added to the cache when it commits and are thrown away if it rolls
+        back or the session is closed first, so the cache never points at a row that was never committed. It doesn't know about
+        rows deleted after they were cached-- clear() it if that happens.
+
+        >>> host_cache = IdentityCache(max_size = 50000)
+        >>> host = get_or_create(Host, {'name': 'web01'}, db_session, cache = host_cache)
+
+        :param max_size: most entries to keep
+        '''
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        _listen_for_transaction_ends()
+
+    def get(self, key):
+        with self._lock:
+            primary_key = self._entries.pop(key, None)
+            if primary_key is not None:
+                self._entries[key] = primary_key
+            return primary_key
+
+    def put(self, key, primary_key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = primary_key
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, object_class, object_dict, db_session):
+        '''
+        :return: the cached row as an instance in db_session, or None on a miss
+        '''
+        primary_key = self.get((object_class, _freeze(object_dict)))
+        if primary_key is None:
+            return None
+        mapper = class_mapper(object_class)
+        orm_object = db_session.identity_map.get(mapper.identity_key_from_primary_key(primary_key))
+        if orm_object is not None:
+            return orm_object
+        # Build it from what we know and merge it in without loading. Columns that weren't in
+        # object_dict are expired and load if they're touched.
+        orm_object = object_class(**object_dict)
+        for column, value in zip(mapper.primary_key, primary_key):
+            setattr(orm_object, mapper.get_property_by_column(column).key, value)
+        make_transient_to_detached(orm_object)
+        return db_session.merge(orm_object, load=False)
+
+    def record(self, object_class, object_dict, orm_object, db_session):
+        '''
+        Remembers orm_object for object_dict once db_session's transaction commits. If that
+        transaction rolls back or the session is closed first, it's forgotten.
+        '''
+        primary_key = tuple(class_mapper(object_class).primary_key_from_instance(orm_object))
+        session = db_session.registry() if isinstance(db_session, scoped_session) else db_session
+        transaction = _root_transaction(session.transaction)
+        session.info.setdefault(_PENDING_INFO_KEY, {}).setdefault(transaction, []).append(
+            (self, (object_class, _freeze(object_dict)), primary_key))
+
+
+def _retry_on_operational_error(f, db_session, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            return f()
+        except OperationalError:
+            db_session.rollback()
+            if attempt == retries:
+                raise
+            # Full jitter-- anywhere between no wait and the exponential back-off
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+
+def get_or_create(object_class, object_dict, db_session, retries = 3, backoff = 0.05, cache = None):
+    '''
+    Gets the object_class row matching object_dict, creating it if it doesn't exist.
+
+    :param object_class: sqlalchemy ORM class
+    :param object_dict: column values, covering a unique constraint
+    :param db_session: sqlalchemy session. It's rolled back if the row already exists.
+    :param retries: times to retry on OperationalError (deadlocks and lock wait timeouts)
+    :param backoff: seconds of back-off before the first retry, doubling for each retry after
+    :param cache: optional IdentityCache. Hits come back without a database round-trip.
+    :return: the ORM object
+    '''
+    if cache is not None:
+        orm_object = cache.lookup(object_class, object_dict, db_session)
+        if orm_object is not None:
+            return orm_object
+    orm_object = _retry_on_operational_error(lambda: _get_or_create(object_class, object_dict, db_session),
+                                             db_session, retries, backoff)
+    if cache is not None and orm_object is not None:
+        cache.record(object_class, object_dict, orm_object, db_session)
+    return orm_object
+
+
+def _get_or_create(object_class, object_dict, db_session):
     orm_object = object_class(**object_dict)
     db_session.add(orm_object)
     try:
@@ -20,15 +178,57 @@ def get_or_create(object_class, object_dict, db_session):
     return orm_object
 
 
-def get_or_create_list(object_class, object_dict_list, db_session):
+def get_or_create_list(object_class, object_dict_list, db_session, retries = 3, backoff = 0.05,
+                       chunk_size = 500, cache = None):
+    '''
+    Gets or creates a row for each dict in object_dict_list.
+
+    On PostgreSQL, MySQL and SQLite this is a bulk operation-- rows that already exist are selected
+    chunk_size at a time, the missing ones are inserted with INSERT ... ON CONFLICT DO NOTHING
+    (INSERT IGNORE on MySQL, INSERT OR IGNORE on SQLite) and then selected. Rows other writers insert
+    in the meantime are simply skipped over. Elsewhere, everything is flushed optimistically and the
+    list is split in half on IntegrityError.
+
+    On MySQL, INSERT IGNORE also turns errors other than duplicate keys into warnings.
+
+    :param object_class: sqlalchemy ORM class
+    :param object_dict_list: list of dicts of column values, each covering a unique constraint
+    :param db_session: sqlalchemy session
+    :param retries: times to retry on OperationalError (deadlocks and lock wait timeouts)
+    :param backoff: seconds of back-off before the first retry, doubling for each retry after
+    :param chunk_size: rows per select and per insert on the bulk path
+    :param cache: optional IdentityCache. Only the misses go to the database.
+    :return: list of ORM objects in the same order as object_dict_list
+    '''
+    if cache is not None:
+        result = [cache.lookup(object_class, object_dict, db_session) for object_dict in object_dict_list]
+        missed = [index for index, orm_object in enumerate(result) if orm_object is None]
+        if missed:
+            missed_dicts = [object_dict_list[index] for index in missed]
+            created = get_or_create_list(object_class, missed_dicts, db_session, retries, backoff, chunk_size)
+            for index, object_dict, orm_object in zip(missed, missed_dicts, created):
+                result[index] = orm_object
+                if orm_object is not None:
+                    cache.record(object_class, object_dict, orm_object, db_session)
+        return result
+    insert_statement = _insert_ignore_statement(object_class, db_session)
+    if insert_statement is None:
+        f = lambda: _get_or_create_list(object_class, object_dict_list, db_session)
+    else:
+        f = lambda: _bulk_get_or_create_list(object_class, object_dict_list, db_session, insert_statement,
+                                             chunk_size)
+    return _retry_on_operational_error(f, db_session, retries, backoff)
+
+
+def _get_or_create_list(object_class, object_dict_list, db_session):
     if len(object_dict_list) < 4:
         return _pessimistic_get_or_create_list(object_class, object_dict_list, db_session)
     try:
         return _optimistic_get_or_create_list(object_class, object_dict_list, db_session)
     except IntegrityError as e:
         db_session.rollback()
-        return get_or_create_list(object_class, object_dict_list[::2], db_session) + \
-               get_or_create_list(object_class, object_dict_list[1::2], db_session)
+        return _get_or_create_list(object_class, object_dict_list[::2], db_session) + \
+               _get_or_create_list(object_class, object_dict_list[1::2], db_session)
 
 
 def _optimistic_get_or_create_list(object_class, object_dict_list, db_session):
@@ -39,5 +239,63 @@ def _optimistic_get_or_create_list(object_class, object_dict_list, db_session):
 
 
 def _pessimistic_get_or_create_list(object_class, object_dict_list, db_session):
-    return [get_or_create(object_class, object_dict, db_session) for object_dict in object_dict_list]
+    return [_get_or_create(object_class, object_dict, db_session) for object_dict in object_dict_list]
+
+
+def _insert_ignore_statement(object_class, db_session):
+    '''
+    :return: an insert for object_class's table that skips rows violating a unique constraint, or None
+     if the dialect can't do that
+    '''
+    mapper = class_mapper(object_class)
+    return insert_ignore_statement(mapper.local_table, db_session.get_bind(mapper).dialect.name)
+
+
+def _freeze(object_dict):
+    return frozenset(object_dict.items())
+
+
+def _select_existing(object_class, object_dict_list, db_session, chunk_size):
+    '''
+    :return: dict of frozen object dict to the ORM object for the rows that exist
+    '''
+    existing = {}
+    # Dicts with different keys need different filters
+    by_keys = OrderedDict()
+    for object_dict in object_dict_list:
+        by_keys.setdefault(tuple(sorted(object_dict)), []).append(object_dict)
+    for keys, dict_group in by_keys.items():
+        columns = [getattr(object_class, key) for key in keys]
+        for dict_chunk in chunks(dict_group, chunk_size):
+            if len(keys) == 1:
+                condition = columns[0].in_([object_dict[keys[0]] for object_dict in dict_chunk])
+            else:
+                condition = or_(*[and_(*[column == object_dict[key] for column, key in zip(columns, keys)])
+                                  for object_dict in dict_chunk])
+            for orm_object in db_session.query(object_class).filter(condition):
+                existing[_freeze({key: getattr(orm_object, key) for key in keys})] = orm_object
+    return existing
+
 
+def _bulk_get_or_create_list(object_class, object_dict_list, db_session, insert_statement, chunk_size):
+    mapper = class_mapper(object_class)
+    unique_dicts = OrderedDict((_freeze(object_dict), object_dict) for object_dict in object_dict_list)
+    found = _select_existing(object_class, unique_dicts.values(), db_session, chunk_size)
+    missing = [object_dict for frozen, object_dict in unique_dicts.items() if frozen not in found]
+    if missing:
+        for dict_chunk in chunks(missing, chunk_size):
+            # executemany, with the ORM attribute names turned into column names
+            db_session.execute(insert_statement,
+                               [{mapper.get_property(key).columns[0].key: value
+                                 for key, value in object_dict.items()}
+                                for object_dict in dict_chunk])
+        found.update(_select_existing(object_class, missing, db_session, chunk_size))
+    result = []
+    for object_dict in object_dict_list:
+        frozen = _freeze(object_dict)
+        if frozen not in found:
+            # The database matched it to a row whose values compare differently in Python (a
+            # case-insensitive collation, say). It's there, so look it up on its own.
+            found[frozen] = db_session.query(object_class).filter_by(**object_dict).first()
+        result.append(found[frozen])
+    return result
@@ -0,0 +1,18 @@
+from sqlalchemy.dialects import postgresql
+
+
+def insert_ignore_statement(table, dialect_name):
+    '''
+    Builds an insert that skips rows violating a unique constraint instead of failing the statement.
+
+    :param table: sqlalchemy Table to insert into
+    :param dialect_name: name of the dialect the statement will run on, e.g. engine.dialect.name
+    :return: the insert, or None if the dialect can't do that
+    '''
+    if dialect_name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect_name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    if dialect_name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return None
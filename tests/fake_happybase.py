@@ -0,0 +1,155 @@
+'''
+A small in-process stand-in for the parts of happybase the HBase dicts use: pool.connection(),
+connection.table() and the row, rows, put, delete, scan and batch methods of a table.
+
+Cells are versioned and deletes leave tombstones that mask cells with the same timestamp or older,
+as in HBase. Mutations sent without a timestamp get the "server" time, which here always moves
+forward, whereas a real region server can hand out the same millisecond twice.
+'''
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class FakeTable(object):
+    def __init__(self, families):
+        self.families = families
+        # Row key to column to list of (timestamp, value)
+        self.cells = defaultdict(dict)
+        # Row key to column family or column to the newest delete timestamp
+        self.tombstones = defaultdict(dict)
+        # Method name to number of calls, so tests can check how many round-trips were made
+        self.calls = defaultdict(int)
+        # The timestamp passed to each batch(), so tests can check they're left to the server
+        self.batch_timestamps = []
+        # The filter passed to each scan(), so tests can check values were left out
+        self.scan_filters = []
+        self._clock = 0
+
+    def server_time(self):
+        self._clock += 1
+        return self._clock
+
+    def _visible(self, row, column):
+        family = column.split(':')[0]
+        deleted_at = max(self.tombstones[row].get(family, -1), self.tombstones[row].get(column, -1))
+        live = [(timestamp, value) for timestamp, value in self.cells[row].get(column, [])
+                if timestamp > deleted_at]
+        return max(live)[1] if live else None
+
+    def _row(self, row, columns):
+        result = {}
+        for column in self.cells.get(row, {}):
+            if columns is None or any(column == wanted or (':' not in wanted and column.startswith(wanted + ':'))
+                                      for wanted in columns):
+                value = self._visible(row, column)
+                if value is not None:
+                    result[column] = value
+        return result
+
+    def apply_put(self, row, data, timestamp):
+        for column, value in data.items():
+            if column.split(':')[0] not in self.families:
+                raise Exception('No such column family: %s' % column)
+            self.cells[row].setdefault(column, []).append((timestamp, value))
+
+    def apply_delete(self, row, columns, timestamp):
+        for column in (columns if columns is not None else self.families):
+            self.tombstones[row][column] = max(timestamp, self.tombstones[row].get(column, -1))
+
+    def row(self, row, columns = None):
+        self.calls['row'] += 1
+        return self._row(row, columns)
+
+    def rows(self, rows, columns = None):
+        self.calls['rows'] += 1
+        return [(row, data) for row, data in ((row, self._row(row, columns)) for row in rows) if data]
+
+    def put(self, row, data, timestamp = None):
+        self.calls['put'] += 1
+        self.apply_put(row, data, timestamp if timestamp is not None else self.server_time())
+
+    def delete(self, row, columns = None, timestamp = None):
+        self.calls['delete'] += 1
+        self.apply_delete(row, columns, timestamp if timestamp is not None else self.server_time())
+
+    def scan(self, row_start = None, row_stop = None, columns = None, filter = None, batch_size = 1000,
+             limit = None):
+        self.calls['scan'] += 1
+        self.scan_filters.append(filter)
+        returned = 0
+        for row in sorted(self.cells):
+            if (row_start is not None and row < row_start) or (row_stop is not None and row >= row_stop):
+                continue
+            if limit is not None and returned >= limit:
+                return
+            data = self._row(row, columns)
+            if not data:
+                continue
+            if filter is not None and 'KeyOnlyFilter' in filter:
+                data = dict((column, '') for column in data)
+                if 'FirstKeyOnlyFilter' in filter:
+                    data = dict([min(data.items())])
+            returned += 1
+            yield row, data
+
+    def batch(self, timestamp = None, batch_size = None):
+        self.batch_timestamps.append(timestamp)
+        return FakeBatch(self, timestamp, batch_size)
+
+
+class FakeBatch(object):
+    def __init__(self, table, timestamp, batch_size):
+        self.table = table
+        self.timestamp = timestamp
+        self.batch_size = batch_size
+        self.mutations = []
+
+    def put(self, row, data):
+        self.mutations.append(('put', row, data))
+        self._send_if_full()
+
+    def delete(self, row, columns = None):
+        self.mutations.append(('delete', row, columns))
+        self._send_if_full()
+
+    def _send_if_full(self):
+        if self.batch_size and len(self.mutations) >= self.batch_size:
+            self.send()
+
+    def send(self):
+        if not self.mutations:
+            return
+        self.table.calls['batch_send'] += 1
+        timestamp = self.timestamp if self.timestamp is not None else self.table.server_time()
+        # Everything in a send shares a timestamp, so a delete masks a put of the same column
+        # whichever order they were added in
+        for kind, row, argument in self.mutations:
+            if kind == 'delete':
+                self.table.apply_delete(row, argument, timestamp)
+        for kind, row, argument in self.mutations:
+            if kind == 'put':
+                self.table.apply_put(row, argument, timestamp)
+        self.mutations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.send()
+
+
+class FakeConnection(object):
+    def __init__(self, tables):
+        self.tables = tables
+
+    def table(self, name):
+        return self.tables[name]
+
+
+class FakeConnectionPool(object):
+    def __init__(self, tables):
+        self._connection = FakeConnection(tables)
+
+    @contextmanager
+    def connection(self):
+        yield self._connection
@@ -0,0 +1,69 @@
+'''
+GenericSqlDict tests against SQLite files in a temp dir.
+
+    python -m unittest discover tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import select, func
+from shitty_tools.key_value.sql.generic_sql import GenericSqlDict
+from shitty_tools.key_value.sql.sqlite import SqliteDict
+
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.url = 'sqlite:///%s' % os.path.join(self.path, 'kv.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def history_rows(self, kv_dict):
+        return kv_dict._engine.execute(select([func.count()]).select_from(kv_dict._kv_table)).scalar()
+
+    def check_compaction(self, kv_dict):
+        keys = ['k%05d' % i for i in range(1500)]
+        kv_dict.set_many((key, 'a') for key in keys)
+        kv_dict.set_many((key, 'b') for key in keys)
+        for key in keys[:1200]:
+            del kv_dict[key]
+        kv_dict['k00000'] = 'again'
+        # Every superseded version, including k00000's tombstone, then the rest of the tombstones,
+        # more than a batch of them
+        self.assertEqual(kv_dict.compact(), 1500 + 1201 + 1199)
+        self.assertEqual(self.history_rows(kv_dict), 301)
+        self.assertEqual(len(kv_dict), 301)
+        self.assertEqual(kv_dict['k00000'], 'again')
+        self.assertEqual(kv_dict['k01499'], 'b')
+        self.assertRaises(KeyError, lambda: kv_dict['k00001'])
+        kv_dict._engine.dispose()
+
+    def test_more_than_a_batch_of_tombstones(self):
+        self.check_compaction(GenericSqlDict(self.url, 'kv'))
+
+    def test_more_than_a_batch_of_tombstones_with_a_current_table(self):
+        self.check_compaction(GenericSqlDict(self.url, 'kv', current_table=True))
+
+    def test_more_than_a_batch_of_tombstones_on_sqlite_dict(self):
+        self.check_compaction(SqliteDict(self.url, 'kv', keep_history=True))
+
+
+class CloseTest(unittest.TestCase):
+    def test_close_stops_compaction(self):
+        path = tempfile.mkdtemp()
+        try:
+            kv_dict = GenericSqlDict('sqlite:///%s' % os.path.join(path, 'kv.db'), 'kv')
+            kv_dict['a'] = '1'
+            kv_dict['a'] = '2'
+            compaction_thread = kv_dict.start_compaction(interval=0.01)
+            kv_dict.close()
+            self.assertFalse(compaction_thread.is_alive())
+            self.assertEqual(kv_dict.compact(), 0)
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+get_or_create and IdentityCache tests against a SQLite file in a temp dir.
+
+    python -m unittest discover tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import create_engine, event, Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, scoped_session
+from shitty_tools.sqla.get_or_create import IdentityCache, get_or_create, get_or_create_list
+
+
+Base = declarative_base()
+
+
+class Host(Base):
+    __tablename__ = 'host'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+
+
+class IdentityCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(self.path, 'hosts.db'))
+        # pysqlite's own transaction handling breaks SAVEPOINT, so let sqlalchemy emit BEGIN itself
+        event.listen(self.engine, 'connect', lambda dbapi_connection, record:
+                     setattr(dbapi_connection, 'isolation_level', None))
+        event.listen(self.engine, 'begin', lambda connection: connection.execute('BEGIN'))
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(self.engine)
+        self.cache = IdentityCache()
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def cached_name(self, name):
+        session = self.Session()
+        try:
+            host = self.cache.lookup(Host, {'name': name}, session)
+            return None if host is None else session.query(Host.name).filter_by(id=host.id).scalar()
+        finally:
+            session.close()
+
+    def test_entries_are_published_on_commit(self):
+        session = self.Session()
+        get_or_create(Host, {'name': 'a'}, session, cache=self.cache)
+        self.assertEqual(len(self.cache), 0)
+        session.commit()
+        self.assertEqual(self.cached_name('a'), 'a')
+
+    def test_rollback_discards_entries(self):
+        session = self.Session()
+        get_or_create(Host, {'name': 'ghost'}, session, cache=self.cache)
+        session.rollback()
+        session.commit()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_close_without_commit_discards_entries(self):
+        session = self.Session()
+        get_or_create(Host, {'name': 'ghost'}, session, cache=self.cache)
+        session.close()
+        # The same session carries on in a new transaction, and SQLite hands out the id again
+        get_or_create(Host, {'name': 'real'}, session, cache=self.cache)
+        session.commit()
+        self.assertEqual(self.cached_name('ghost'), None)
+        self.assertEqual(self.cached_name('real'), 'real')
+
+    def test_savepoints_wait_for_the_outer_commit(self):
+        session = self.Session()
+        session.begin_nested()
+        get_or_create_list(Host, [{'name': 'a'}, {'name': 'b'}], session, cache=self.cache)
+        session.commit()
+        self.assertEqual(len(self.cache), 0)
+        session.commit()
+        self.assertEqual(len(self.cache), 2)
+
+    def test_scoped_sessions(self):
+        session = scoped_session(self.Session)
+        get_or_create(Host, {'name': 'a'}, session, cache=self.cache)
+        session.remove()
+        self.assertEqual(len(self.cache), 0)
+        get_or_create(Host, {'name': 'b'}, session, cache=self.cache)
+        session.commit()
+        self.assertEqual(self.cached_name('b'), 'b')
+        session.remove()
+
+
+if __name__ == '__main__':
+    unittest.main()
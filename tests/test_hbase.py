@@ -0,0 +1,200 @@
+'''
+HBase dict tests against the in-process fake in fake_happybase, so no cluster is needed.
+
+    python -m unittest discover tests
+'''
+import unittest
+from shitty_tools.key_value.hbase import HbaseCfDict, HbaseRowDict, HbaseValueDict, KEY_ONLY_FILTER
+from tests.fake_happybase import FakeTable, FakeConnectionPool
+
+
+class HbaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable(['cf', 'other'])
+        self.pool = FakeConnectionPool({'t': self.table})
+
+    def cf_dict(self, **kwargs):
+        return HbaseCfDict(self.pool, 't', 'cf', **kwargs)
+
+    def row_dict(self, row_key='r1', **kwargs):
+        return HbaseRowDict(self.pool, 't', 'cf', row_key, **kwargs)
+
+    def value_dict(self, **kwargs):
+        return HbaseValueDict(self.pool, 't', 'cf:value', **kwargs)
+
+
+class CfSetManyTest(HbaseTestCase):
+    def test_replacing_a_row_drops_the_old_columns(self):
+        cf = self.cf_dict()
+        cf['r1'] = {'a': '1', 'b': '2'}
+        cf['r1'] = {'a': '3'}
+        self.assertEqual(dict(cf['r1']), {'a': '3'})
+        cf['r1'] = {}
+        self.assertEqual(dict(cf['r1']), {})
+
+    def test_other_column_families_are_left_alone(self):
+        self.table.put('r1', {'other:x': 'keep'})
+        self.cf_dict()['r1'] = {'a': '1'}
+        self.assertEqual(self.table.row('r1'), {'cf:a': '1', 'other:x': 'keep'})
+
+    def test_timestamps_are_left_to_the_server(self):
+        cf = self.cf_dict()
+        cf['r1'] = {'a': '1'}
+        cf['r1'] = {'b': '2'}
+        self.assertEqual(set(self.table.batch_timestamps), set([None]))
+
+    def test_set_many_reads_and_writes_batch_size_rows_per_call(self):
+        cf = self.cf_dict(batch_size=10)
+        cf.set_many(('r%02d' % i, {'a': str(i)}) for i in range(25))
+        self.assertEqual(self.table.calls['rows'], 3)
+        self.assertEqual(self.table.calls['batch_send'], 3)
+        cf.set_many(('r%02d' % i, {'b': str(i)}) for i in range(25))
+        self.assertEqual(cf.get_many(['r00', 'r24']), {'r00': {'b': '0'}, 'r24': {'b': '24'}})
+
+    def test_the_last_write_to_a_row_wins(self):
+        cf = self.cf_dict()
+        cf.set_many([('r1', {'a': '1'}), ('r1', {'b': '2'})])
+        self.assertEqual(dict(cf['r1']), {'b': '2'})
+
+
+class CfPrefetchTest(HbaseTestCase):
+    def test_replacements_are_buffered_until_flush(self):
+        cf = self.cf_dict(prefetch=True)
+        cf['r1'] = {'a': '1'}
+        cf.set_many({'r2': {'b': '2'}})
+        self.assertEqual(self.table.calls['batch_send'], 0)
+        self.assertEqual(dict(cf['r1']), {'a': '1'})
+        cf.flush()
+        self.assertEqual(self.table.calls['batch_send'], 1)
+        self.assertEqual(self.cf_dict().get_many(['r1', 'r2']), {'r1': {'a': '1'}, 'r2': {'b': '2'}})
+
+    def test_with_block_flushes(self):
+        cf = self.cf_dict(prefetch=True)
+        self.table.put('r1', {'cf:old': 'x'})
+        with cf:
+            cf['r1'] = {'a': '1'}
+        self.assertEqual(self.cf_dict().get_many(['r1']), {'r1': {'a': '1'}})
+
+    def test_items_come_from_one_scan(self):
+        self.cf_dict().set_many({'r1': {'a': '1'}, 'r2': {'b': '2'}})
+        cf = self.cf_dict(prefetch=True)
+        self.assertEqual(dict((rowkey, dict(row)) for rowkey, row in cf.items()),
+                         {'r1': {'a': '1'}, 'r2': {'b': '2'}})
+        self.assertEqual(self.table.calls['scan'], 1)
+        self.assertEqual(self.table.calls['row'], 0)
+
+    def test_writes_to_rows_handed_out_are_flushed(self):
+        self.cf_dict().set_many({'r1': {'a': '1'}, 'r2': {'a': '1'}})
+        cf = self.cf_dict(prefetch=True)
+        with cf:
+            cf['r1']['b'] = '2'
+            row = cf['r2']
+            row['c'] = '3'
+            del row['a']
+            self.assertEqual(self.table.calls['batch_send'], 1)
+        self.assertEqual(self.cf_dict().get_many(['r1', 'r2']), {'r1': {'a': '1', 'b': '2'}, 'r2': {'c': '3'}})
+        self.assertEqual(self.table.calls['batch_send'], 2)
+
+    def test_rows_handed_out_after_a_replacement_edit_it(self):
+        cf = self.cf_dict(prefetch=True)
+        with cf:
+            cf['r1'] = {'a': '1', 'b': '2'}
+            row = cf['r1']
+            row['c'] = '3'
+            del row['a']
+        self.assertEqual(dict(self.cf_dict()['r1']), {'b': '2', 'c': '3'})
+
+    def test_replacing_a_row_drops_edits_to_rows_handed_out_before(self):
+        cf = self.cf_dict(prefetch=True)
+        with cf:
+            cf['r1']['a'] = '1'
+            cf['r1'] = {'b': '2'}
+        self.assertEqual(dict(self.cf_dict()['r1']), {'b': '2'})
+
+    def test_deletes_are_buffered_and_left_to_the_server(self):
+        self.cf_dict().set_many({'r1': {'a': '1'}, 'r2': {'a': '2'}})
+        self.table.put('r1', {'other:x': 'keep'})
+        cf = self.cf_dict(prefetch=True)
+        with cf:
+            del cf['r1']
+            cf.delete_many(['r2', 'missing'])
+            self.assertEqual(len(cf), 2)
+        self.assertEqual(len(cf), 0)
+        self.assertEqual(self.table.row('r1'), {'other:x': 'keep'})
+        self.assertEqual(set(self.table.batch_timestamps), set([None]))
+
+    def test_a_deleted_row_can_be_set_again(self):
+        cf = self.cf_dict()
+        cf['r1'] = {'a': '1'}
+        del cf['r1']
+        cf['r1'] = {'b': '2'}
+        self.assertEqual(dict(cf['r1']), {'b': '2'})
+
+
+class ValueDictTest(HbaseTestCase):
+    def test_set_many_sends_batch_size_puts_per_call(self):
+        values = self.value_dict(batch_size=10)
+        values.set_many(('k%02d' % i, str(i)) for i in range(25))
+        self.assertEqual(self.table.calls['batch_send'], 3)
+        self.assertEqual(values['k24'], '24')
+
+    def test_get_many_reads_batch_size_keys_per_call(self):
+        values = self.value_dict(batch_size=10)
+        values.set_many(('k%02d' % i, str(i)) for i in range(25))
+        self.table.put('other', {'cf:unrelated': 'x'})
+        result = values.get_many(['k%02d' % i for i in range(25)] + ['missing', 'other'])
+        self.assertEqual(result, dict(('k%02d' % i, str(i)) for i in range(25)))
+        self.assertEqual(self.table.calls['rows'], 3)
+
+    def test_delete_many_sends_batch_size_deletes_per_call(self):
+        values = self.value_dict(batch_size=10)
+        values.set_many(('k%02d' % i, str(i)) for i in range(25))
+        sends = self.table.calls['batch_send']
+        self.table.put('k00', {'cf:unrelated': 'keep'})
+        values.delete_many(['k%02d' % i for i in range(20)] + ['missing'])
+        self.assertEqual(self.table.calls['batch_send'] - sends, 3)
+        self.assertEqual(sorted(values), ['k20', 'k21', 'k22', 'k23', 'k24'])
+        self.assertEqual(self.table.row('k00'), {'cf:unrelated': 'keep'})
+
+    def test_iteration_and_len_scan_keys_only(self):
+        values = self.value_dict()
+        values.set_many({'a': '1', 'b': '2'})
+        self.table.put('c', {'cf:unrelated': 'x'})
+        self.assertEqual(sorted(values), ['a', 'b'])
+        self.assertEqual(len(values), 2)
+        self.assertEqual(set(self.table.scan_filters), set([KEY_ONLY_FILTER]))
+        self.assertEqual(dict(values.items()), {'a': '1', 'b': '2'})
+
+
+class RowDictTest(HbaseTestCase):
+    def test_get_many_is_one_call(self):
+        self.table.put('r1', {'cf:a': '1', 'cf:b': '2', 'cf:c': '3', 'other:a': 'x'})
+        row = self.row_dict()
+        self.assertEqual(row.get_many(['a', 'c', 'missing']), {'a': '1', 'c': '3'})
+        self.assertEqual(self.table.calls['row'], 1)
+        self.assertEqual(row.get_many([]), {})
+        self.assertEqual(self.table.calls['row'], 1)
+
+    def test_set_many_and_delete_many_are_one_call_each(self):
+        row = self.row_dict()
+        row.set_many({'a': '1', 'b': '2', 'c': '3'})
+        self.assertEqual(self.table.calls['put'], 1)
+        row.delete_many(['a', 'b', 'missing'])
+        self.assertEqual(self.table.calls['delete'], 1)
+        self.assertEqual(dict(row), {'c': '3'})
+
+    def test_iteration_and_len_scan_the_row_keys_only(self):
+        self.table.put('r0', {'cf:x': '0'})
+        self.table.put('r1', {'cf:a': '1', 'cf:b': '2', 'other:c': '3'})
+        self.table.put('r1\0', {'cf:y': '0'})
+        self.table.put('r10', {'cf:z': '0'})
+        row = self.row_dict()
+        self.assertEqual(sorted(row), ['a', 'b'])
+        self.assertEqual(len(row), 2)
+        self.assertEqual(len(self.row_dict('missing')), 0)
+        self.assertEqual(self.table.calls['row'], 0)
+        self.assertEqual(set(self.table.scan_filters), set([KEY_ONLY_FILTER]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+'''
+PackFileDict tests in a temp dir.
+
+    python -m unittest discover tests
+'''
+import shutil
+import tempfile
+import unittest
+from shitty_tools.key_value.packfile import PackFileDict
+
+
+class CloseTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_close_stops_compaction(self):
+        kv_dict = PackFileDict(self.path, max_segment_size=100)
+        for i in range(50):
+            kv_dict['k%d' % (i % 5)] = 'x' * 30
+        compaction_thread = kv_dict.start_compaction(interval=0.01, min_dead_fraction=0.0)
+        kv_dict.close()
+        self.assertFalse(compaction_thread.is_alive())
+        self.assertEqual(kv_dict.compact(), 0)
+        reopened = PackFileDict(self.path)
+        self.assertEqual(reopened['k4'], 'x' * 30)
+        reopened.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+'''
+RedisDict near cache tests against a throwaway redis-server on a free port. Skipped if
+redis-server isn't on the PATH or the redis package isn't installed.
+
+    python -m unittest discover tests
+'''
+import os
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+from distutils.spawn import find_executable
+
+try:
+    from redis import Redis
+except ImportError:
+    Redis = None
+
+
+_server = {}
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def setUpModule():
+    if Redis is None:
+        raise unittest.SkipTest('redis is not installed')
+    executable = find_executable('redis-server')
+    if executable is None:
+        raise unittest.SkipTest('redis-server is not on the PATH')
+    port = _free_port()
+    data_path = tempfile.mkdtemp()
+    process = subprocess.Popen([executable, '--port', str(port), '--bind', '127.0.0.1', '--save', '',
+                                '--appendonly', 'no', '--dir', data_path], stdout=open(os.devnull, 'w'))
+    _server.update(process=process, port=port, data_path=data_path)
+    redis_conn = Redis('127.0.0.1', port)
+    for _ in range(100):
+        try:
+            redis_conn.ping()
+            return
+        except Exception:
+            time.sleep(0.05)
+    tearDownModule()
+    raise Exception('redis-server did not start on port %s' % port)
+
+
+def tearDownModule():
+    if 'process' in _server:
+        _server['process'].kill()
+        _server['process'].wait()
+        shutil.rmtree(_server['data_path'])
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class NearCacheTestCase(unittest.TestCase):
+    notify_keyspace_events = 'KEA'
+
+    def setUp(self):
+        from shitty_tools.key_value.redis import RedisDict
+        self.redis = Redis('127.0.0.1', _server['port'])
+        self.redis.flushdb()
+        self.redis.config_set('notify-keyspace-events', self.notify_keyspace_events)
+        # A second client standing in for another process writing to the same keys
+        self.other_writer = Redis('127.0.0.1', _server['port'])
+        self.kv_dict = RedisDict(self.redis, 'nc:', near_cache_size=100, near_cache_ttl=0.5)
+
+    def tearDown(self):
+        self.kv_dict.close()
+
+
+class TrackingTest(NearCacheTestCase):
+    def setUp(self):
+        super(TrackingTest, self).setUp()
+        self.assertTrue(wait_for(lambda: self.kv_dict.near_cache_stats()['mode'] == 'tracking'))
+
+    def test_hits_are_served_locally(self):
+        self.kv_dict['a'] = '1'
+        self.assertEqual(self.kv_dict['a'], '1')
+        self.assertEqual(self.kv_dict['a'], '1')
+        self.assertEqual(self.kv_dict.near_cache_stats()['hits'], 1)
+
+    def test_local_write_invalidates(self):
+        self.kv_dict['a'] = '1'
+        self.kv_dict['a']
+        self.kv_dict['a'] = '2'
+        self.assertEqual(self.kv_dict['a'], '2')
+        del self.kv_dict['a']
+        self.assertRaises(KeyError, lambda: self.kv_dict['a'])
+
+    def test_other_writer_invalidates(self):
+        self.other_writer.set('nc:a', '1')
+        self.assertEqual(self.kv_dict['a'], '1')
+        self.other_writer.set('nc:a', '2')
+        # Entries don't expire while tracking, so only the keyspace notification can get rid of it
+        self.assertTrue(wait_for(lambda: self.kv_dict['a'] == '2'))
+        self.other_writer.delete('nc:a')
+        self.assertTrue(wait_for(lambda: 'a' not in self.kv_dict))
+
+    def test_read_racing_an_invalidation_is_not_cached(self):
+        self.other_writer.set('nc:a', 'old')
+        read = self.kv_dict._read
+        def racing_read(key):
+            value = read(key)
+            # Another writer changes the key after we've read it but before we get to cache it
+            invalidations = self.kv_dict.near_cache_stats()['invalidations']
+            self.other_writer.set('nc:a', 'new')
+            self.assertTrue(wait_for(lambda: self.kv_dict.near_cache_stats()['invalidations'] > invalidations))
+            return value
+        self.kv_dict._read = racing_read
+        self.assertEqual(self.kv_dict['a'], 'old')
+        self.kv_dict._read = read
+        self.assertEqual(self.kv_dict['a'], 'new')
+
+    def test_get_many_fills_and_uses_the_cache(self):
+        self.kv_dict.set_many({'a': '1', 'b': '2'})
+        self.assertEqual(self.kv_dict.get_many(['a', 'b', 'c']), {'a': '1', 'b': '2'})
+        self.assertEqual(self.kv_dict.get_many(['a', 'b']), {'a': '1', 'b': '2'})
+        self.assertEqual(self.kv_dict.near_cache_stats()['hits'], 2)
+
+
+class TtlFallbackTest(NearCacheTestCase):
+    notify_keyspace_events = ''
+
+    def test_mode_is_ttl(self):
+        self.assertEqual(self.kv_dict.near_cache_stats()['mode'], 'ttl')
+
+    def test_other_writes_are_seen_after_the_ttl(self):
+        self.other_writer.set('nc:a', '1')
+        self.assertEqual(self.kv_dict['a'], '1')
+        self.other_writer.set('nc:a', '2')
+        # No notifications, so the stale value is served until it expires
+        self.assertEqual(self.kv_dict['a'], '1')
+        time.sleep(0.6)
+        self.assertEqual(self.kv_dict['a'], '2')
+
+    def test_local_write_invalidates(self):
+        self.kv_dict['a'] = '1'
+        self.kv_dict['a']
+        self.kv_dict['a'] = '2'
+        self.assertEqual(self.kv_dict['a'], '2')
+
+
+if __name__ == '__main__':
+    unittest.main()